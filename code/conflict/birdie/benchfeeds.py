@@ -0,0 +1,85 @@
+"""Rough timings for birdie feeds of users following many accounts.
+
+Run it from this directory, with birdie and its requirements installed::
+
+    $ python benchfeeds.py
+"""
+import random
+import time
+
+from itertools import islice
+
+from BTrees.OOBTree import OOTreeSet
+from persistent.list import PersistentList
+
+from birdie.models import Chirps
+
+FOLLOWS = (10, 100, 1000, 5000)
+AUTHORS = 10000
+
+def populate(chirps, pushes=1000):
+    random.seed(0)
+    for i in range(pushes):
+        chirps.push(created_by='user%d' % random.randrange(AUTHORS),
+                    chirp='Chirp number %d' % i)
+
+def following(count):
+    return ['user%d' % i for i in random.sample(xrange(AUTHORS), count)]
+
+def bench_membership(chirps, follows, container, repeat=10):
+    """Filter every chirp on the stack by its author, like feeds used to.
+
+    Returns the average time a pass over the stack took.
+    """
+    follows = container(follows)
+    start = time.time()
+    for i in range(repeat):
+        for gen, index, mapping in chirps:
+            mapping['created_by'] in follows
+    return (time.time() - start) / repeat
+
+def bench_follow(follows, container, repeat=100):
+    """Follow and unfollow an account when already following many.
+
+    Returns the average time of a follow and an unfollow.
+    """
+    follows = container(follows)
+    add = getattr(follows, 'append', None) or follows.add
+    start = time.time()
+    for i in range(repeat):
+        add('someone')
+        follows.remove('someone')
+    return (time.time() - start) / repeat
+
+def bench_feed(chirps, follows, repeat=10):
+    """Read the first page of a feed.
+
+    Returns the average time it took.
+    """
+    follows = set(follows)
+    start = time.time()
+    for i in range(repeat):
+        list(islice(chirps.checked(follows), 20))
+    return (time.time() - start) / repeat
+
+def main():
+    chirps = Chirps()
+    populate(chirps)
+    print('%10s %12s %16s %16s' % ('follows', 'container', 'filter (ms)',
+                                   'follow (us)'))
+    for count in FOLLOWS:
+        follows = following(count)
+        for container in (PersistentList, set, OOTreeSet):
+            filtered = bench_membership(chirps, follows, container)
+            followed = bench_follow(follows, container)
+            print('%10d %12s %16.2f %16.1f' % (count, container.__name__,
+                                               filtered * 1e3,
+                                               followed * 1e6))
+    print('')
+    print('%10s %16s' % ('follows', 'feed page (ms)'))
+    for count in FOLLOWS:
+        print('%10d %16.2f' % (count, bench_feed(chirps, following(count))
+                               * 1e3))
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,14 @@ def main(global_config, **settings):
     if zodb_uri is False:
         raise ValueError("No 'zodb_uri' in application configuration.")
 
-    finder = PersistentApplicationFinder(zodb_uri, appmaker)
+    fan_out_limit = settings.get('fan_out_limit')
+    if fan_out_limit is not None:
+        fan_out_limit = int(fan_out_limit)
+
+    def make_app(zodb_root):
+        return appmaker(zodb_root, fan_out_limit)
+
+    finder = PersistentApplicationFinder(zodb_uri, make_app)
     def get_root(request):
         return finder(request.environ)
     authentication_policy = AuthTktAuthenticationPolicy('b1rd13')
@@ -1,9 +1,22 @@
+import random
+import time
+
+from calendar import timegm
+from datetime import datetime
+from heapq import merge
+from itertools import islice
+
+import transaction
+
 from persistent import Persistent
 from persistent.mapping import PersistentMapping
-from persistent.list import PersistentList
 
 from appendonly import AppendStack
 
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
+from BTrees.Length import Length
+
 from cryptacular.bcrypt import BCRYPTPasswordManager
 
 from pyramid.security import Allow
@@ -16,33 +29,227 @@ class Birdie(PersistentMapping):
     __acl__ = [(Allow, Authenticated, 'view')]
 
 class Chirps(Persistent):
+    """The chirps of all the users, newest first.
+
+    Besides the stack, every author has a Timeline of postings pointing to
+    their chirps, so a feed only has to read the chirps of the authors it
+    follows. Every chirp gets a key when it is pushed, made of the time it
+    was posted, in microseconds, and a random number to tell apart chirps
+    posted at the same time. Unlike a position in the stack, the key stays
+    the same when the stack resolves concurrent pushes, so the postings
+    never need to conflict. Feeds yield and take the two numbers of the
+    key instead of the position, and leave out the chirps older than the
+    oldest one the stack still holds, like they did when they read the
+    stack itself.
+
+    With fan out enabled, push also adds every chirp to a Timeline inbox
+    for each follower of its author, so reading a feed is reading an
+    inbox. Following someone calls backfill, which delivers the chirps
+    they posted before. Authors with more followers than ``fan_out_limit`` would take
+    too long to deliver to, so their chirps are left in the postings, and
+    the feeds of their followers merge them in.
+    """
+
+    _authors = None
+    _inboxes = None
+    _undelivered = None
+    fan_out_limit = None
+    # how far before its cursor newer looks, in microseconds
+    overlap = 10 * 1000000
+
     def __init__(self):
         self._stack = AppendStack()
+        self._authors = OOBTree()
 
     def __iter__(self):
         for gen, index, mapping in self._stack:
             yield gen, index, mapping
 
-    def checked(self, follows):
-        for gen, index, mapping in self._stack:
-            created_by = mapping.get('created_by', None)
-            if created_by in follows:
-                yield gen, index, mapping
+    def _index(self):
+        if self._authors is None:
+            # created before the index existed
+            self._authors = OOBTree()
+            stamp = None
+            for gen, index, mapping in reversed(list(self._stack)):
+                if 'key' not in mapping:
+                    mapping['key'] = chirp_key(mapping, stamp)
+                stamp = mapping['key'][0]
+                self._post(mapping)
+        return self._authors
+
+    def _post(self, mapping):
+        created_by = mapping.get('created_by', None)
+        if created_by is None:
+            return
+        postings = self._authors.get(created_by)
+        if postings is None:
+            postings = self._authors[created_by] = Timeline()
+        postings.add(mapping)
+
+    def _horizon(self):
+        """Return the negated key of the oldest chirp in the stack."""
+        layers = self._stack.__getstate__()[2]
+        items = layers[-1][1]
+        if not items:
+            return None
+        stamp, serial = items[0]['key']
+        return -stamp, -serial
+
+    def enable_fan_out(self, limit):
+        """Deliver the chirps of authors with up to limit followers to the
+        inboxes of their followers. A limit of None turns fan out off."""
+        if limit is not None and self.fan_out_limit is None:
+            if self._inboxes is None:
+                self._inboxes = OOBTree()
+                self._undelivered = OOTreeSet()
+            # the chirps pushed until now are only in the postings
+            self._undelivered.update(self._index().keys())
+        self.fan_out_limit = limit
+
+    def _deliver(self, mapping, followers):
+        created_by = mapping.get('created_by', None)
+        if created_by is None:
+            return
+        # only count as many followers as it takes to reach the limit
+        followers = list(islice(followers, self.fan_out_limit + 1))
+        if len(followers) > self.fan_out_limit:
+            self._undelivered.insert(created_by)
+            return
+        for userid in [created_by] + followers:
+            inbox = self._inboxes.get(userid)
+            if inbox is None:
+                inbox = self._inboxes[userid] = Timeline()
+            inbox.add(mapping)
+
+    def backfill(self, reader, created_by):
+        """Deliver the chirps of created_by still in the stack to the inbox
+        of reader, who just followed them."""
+        if self.fan_out_limit is None or created_by in self._undelivered:
+            return
+        postings = self._index().get(created_by)
+        if postings is None:
+            return
+        inbox = self._inboxes.get(reader)
+        if inbox is None:
+            inbox = self._inboxes[reader] = Timeline()
+        for key, mapping in postings.iteritems(max=self._horizon()):
+            inbox.add(mapping)
+
+    def _delivered(self, inbox, follows, **kw):
+        for key, mapping in inbox.iteritems(**kw):
+            if mapping.get('created_by', None) in follows:
+                yield key, mapping
+
+    def _merged(self, follows, reader=None, newer_than=None,
+                older_than=None):
+        authors = self._index()
+        if not isinstance(follows, (set, frozenset)):
+            follows = set(follows)
+        kw = dict(min=older_than, max=newer_than,
+                  excludemin=older_than is not None,
+                  excludemax=newer_than is not None)
+        horizon = self._horizon()
+        if horizon is not None and (newer_than is None or
+                                    horizon < newer_than):
+            kw.update(max=horizon, excludemax=False)
+        streams = []
+        if reader is not None and self.fan_out_limit is not None:
+            inbox = self._inboxes.get(reader)
+            if inbox is not None:
+                streams.append(self._delivered(inbox, follows, **kw))
+            follows = [created_by for created_by in follows
+                       if created_by in self._undelivered]
+        for created_by in follows:
+            postings = authors.get(created_by)
+            if postings is not None:
+                streams.append(postings.iteritems(**kw))
+        previous = None
+        for key, mapping in merge(*streams):
+            # a chirp can be both delivered and in the postings
+            if key == previous:
+                continue
+            previous = key
+            yield -key[0], -key[1], mapping
+
+    def checked(self, follows, reader=None):
+        return self._merged(follows, reader)
+
+    def newer(self, latest_stamp, latest_serial, follows, reader=None):
+        """Return the chirps newer than the given key, and the ones posted
+        up to ``overlap`` before it.
+
+        Keys are taken when a chirp is pushed, not when it commits, so a
+        chirp that took longer to commit can land just behind one the
+        reader already has. Readers skip the chirps they have by key.
+        """
+        return self._merged(follows, reader,
+                            newer_than=(self.overlap - latest_stamp, 1))
 
-    def newer(self, latest_gen, latest_index, follows):
-        iterable = self.checked(follows)
-        for gen, index, mapping in iterable:
-            if (gen, index) > (latest_gen, latest_index):
-                yield gen, index, mapping
+    def older(self, earliest_stamp, earliest_serial, follows, reader=None):
+        return self._merged(follows, reader,
+                            older_than=(-earliest_stamp, -earliest_serial))
 
-    def older(self, earliest_gen, earliest_index, follows):
-        iterable = self.checked(follows)
-        for gen, index, mapping in iterable:
-            if (gen, index) < (earliest_gen, earliest_index):
-                yield gen, index, mapping
+    def push(self, followers=(), **kw):
+        mapping = PersistentMapping(kw)
+        self._index()
+        latest = None
+        for gen, index, newest in self._stack:
+            latest = newest['key'][0]
+            break
+        mapping['key'] = chirp_key(mapping, latest)
+        self._stack.push(mapping)
+        self._post(mapping)
+        if self.fan_out_limit is not None:
+            self._deliver(mapping, followers)
 
-    def push(self, **kw):
-        self._stack.push(PersistentMapping(kw),)
+def chirp_key(mapping, latest=None):
+    """Return a new key for a chirp: the time it was posted, in
+    microseconds, and a random number.
+
+    The time is moved past latest, the time of the chirp pushed before,
+    so that the keys follow the order of the stack even when the clock
+    doesn't.
+    """
+    timestamp = mapping.get('timestamp', None)
+    if isinstance(timestamp, datetime):
+        stamp = (timegm(timestamp.utctimetuple()) * 1000000 +
+                 timestamp.microsecond)
+    else:
+        stamp = int(time.time() * 1000000)
+    if latest is not None and stamp <= latest:
+        stamp = latest + 1
+    return stamp, random.getrandbits(31)
+
+class Timeline(Persistent):
+    """Chirps keyed by their negated keys, so they iterate newest first.
+
+    The chirps are kept in a BTree and counted by a Length, which both
+    resolve concurrent additions. Once the timeline holds a tenth more
+    than ``size`` chirps, the oldest are dropped to bring it back to size.
+    The stack never holds more than a thousand chirps, so a timeline of
+    that size has all of an author's chirps that are still in the stack.
+    """
+
+    size = 1000
+
+    def __init__(self):
+        self.chirps = OOBTree()
+        self.length = Length()
+
+    def iteritems(self, **kw):
+        return self.chirps.iteritems(**kw)
+
+    def add(self, mapping):
+        stamp, serial = mapping['key']
+        if self.chirps.insert((-stamp, -serial), mapping):
+            self.length.change(1)
+        if self.length() > self.size + self.size // 10:
+            self.trim()
+
+    def trim(self):
+        while self.length() > self.size:
+            del self.chirps[self.chirps.maxKey()]
+            self.length.change(-1)
 
 class Users(PersistentMapping):
     def check(self, userid, password):
@@ -53,18 +260,72 @@ class Users(PersistentMapping):
         return False
 
 class User(object):
+    """A user of the site.
+
+    Users are pickled along with the Users mapping that holds them, so
+    following someone never changes the user itself. The relationships
+    are kept in OOTreeSets, whose buckets are separate records that
+    resolve concurrent inserts and removals of different users, and are
+    counted by Length objects, which resolve concurrent changes too. A
+    follow of a popular user only stores a bucket of their followers and
+    a counter, and commits alongside any other follows of that user.
+    """
+
+    _follows_count = None
+    _followers_count = None
+
     def __init__(self, users, userid, password, fullname, about):
         self.userid = userid
         self.password = crypt.encode(password)
         self.fullname = fullname
         self.about = about
         self.avatar = "/static/avatar.jpg"
-        self.follows = PersistentList()
-        self.followers = PersistentList()
+        self.follows = OOTreeSet()
+        self.followers = OOTreeSet()
+        self._follows_count = Length()
+        self._followers_count = Length()
         self.__parent__ = users
         self.__name__ = userid
 
-def appmaker(zodb_root):
+    def _sets(self):
+        if self._follows_count is None:
+            # users that joined when these were lists, or weren't counted
+            if not isinstance(self.follows, OOTreeSet):
+                self.follows = OOTreeSet(self.follows)
+                self.followers = OOTreeSet(self.followers)
+            self._follows_count = Length(len(self.follows))
+            self._followers_count = Length(len(self.followers))
+            self.__parent__._p_changed = True
+
+    def follows_count(self):
+        if self._follows_count is None:
+            return len(self.follows)
+        return self._follows_count()
+
+    def followers_count(self):
+        if self._followers_count is None:
+            return len(self.followers)
+        return self._followers_count()
+
+    def follow(self, other):
+        self._sets()
+        other._sets()
+        if self.follows.insert(other.userid):
+            self._follows_count.change(1)
+        if other.followers.insert(self.userid):
+            other._followers_count.change(1)
+
+    def unfollow(self, other):
+        self._sets()
+        other._sets()
+        if other.userid in self.follows:
+            self.follows.remove(other.userid)
+            self._follows_count.change(-1)
+        if self.userid in other.followers:
+            other.followers.remove(self.userid)
+            other._followers_count.change(-1)
+
+def appmaker(zodb_root, fan_out_limit=None):
     if not 'app_root' in zodb_root:
         app_root = Birdie()
         app_root['chirps'] = Chirps()
@@ -74,6 +335,9 @@ def appmaker(zodb_root):
         app_root['users'].__parent__ = app_root
         app_root['users'].__name__ = 'users'
         zodb_root['app_root'] = app_root
-        import transaction
+        transaction.commit()
+    chirps = zodb_root['app_root']['chirps']
+    if chirps.fan_out_limit != fan_out_limit:
+        chirps.enable_fan_out(fan_out_limit)
         transaction.commit()
     return zodb_root['app_root']
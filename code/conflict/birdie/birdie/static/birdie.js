@@ -21,6 +21,7 @@ $.widget('birdie.chirps', {
         // set initial state
         this._templates = {};
         this._summary_info = {};
+        this._seen = {};
         this._gen_feed_url();
         // Valid states are: 'on', 'off', 'polling', 'error'
         this._ajax_state = 'on';
@@ -43,6 +44,7 @@ $.widget('birdie.chirps', {
         this.element.empty();
         // reset the summary state
         this._summary_info = {};
+        this._seen = {};
         this._gen_feed_url();
         
         // dump active requests at this point
@@ -116,6 +118,17 @@ $.widget('birdie.chirps', {
         var rows = data[4];
         var row_template = this._getTemplate('item_row');
 
+        // the server sends the chirps just before our last one again, in
+        // case one of them was committed after we saw it, so skip the ones
+        // we already have
+        rows = $.grep(rows, function (row) {
+            if (self._seen[row.key]) {
+                return false;
+            }
+            self._seen[row.key] = true;
+            return true;
+        });
+
         $.each(rows.reverse(), function (key, row) {
             $(row_template({item: row}))
                 .prependTo(self.element)
@@ -17,6 +17,7 @@ def _update_feed_items(entries, app_url):
     feed_items = [dict(x[2]) for x in entries]
     for fi in feed_items:
         fi['timeago'] = str(fi.pop('timestamp').strftime('%Y-%m-%dT%H:%M:%SZ'))
+        fi['key'] = '%d:%d' % fi['key']
     return feed_items
 
 @view_config(context='pyramid.httpexceptions.HTTPForbidden',
@@ -89,7 +90,7 @@ def chirp(request):
             'created_by': userid,
             'timestamp': datetime.utcnow(),
             'avatar': '/static/avatar.jpg'}
-    chirps.push(**info)
+    chirps.push(followers=user.followers, **info)
     return dict(
         app_url = request.application_url,
         static_url = '/static',
@@ -124,8 +125,9 @@ def follow(request):
     userid = authenticated_userid(request)
     users = request.context.__parent__
     user = users[userid]
-    user.follows.append(request.context.userid)
-    request.context.followers.append(userid)
+    user.follow(request.context)
+    chirps = users.__parent__['chirps']
+    chirps.backfill(userid, request.context.userid)
     user_url = resource_url(request.context, request)
     return HTTPFound(location = user_url)
 
@@ -137,8 +139,7 @@ def unfollow(request):
     userid = authenticated_userid(request)
     users = request.context.__parent__
     user = users[userid]
-    user.follows.remove(request.context.userid)
-    request.context.followers.remove(userid)
+    user.unfollow(request.context)
     user_url = resource_url(request.context, request)
     return HTTPFound(location = user_url)
 
@@ -212,25 +213,31 @@ def newest_chirps(request):
     created_by = authenticated_userid(request)
     user = users[created_by]
     if user_chirps != 'True':
-        follows = list(user.follows) + [created_by]
+        follows = set(user.follows)
+        follows.add(created_by)
+        reader = created_by
     else:
         userid = request.params.get('userid')
         follows = [userid]
+        reader = None
 
     if newer_than:
         last_gen, last_index = newer_than.split(':')
         last_gen = long(last_gen)
         last_index = int(last_index)
-        latest = list(chirps.newer(last_gen, last_index, follows))
+        latest = list(chirps.newer(last_gen, last_index, follows, reader))
     else:
         last_gen = -1L
         last_index = -1
-        latest = list(islice(chirps.checked(follows), 20))
+        latest = list(islice(chirps.checked(follows, reader), 20))
 
     if not latest:
         return (last_gen, last_index, last_gen, last_index, ())
 
-    last_gen, last_index, ignored = latest[0]
+    # newer also returns a few chirps from before the cursor, which must
+    # not move it back
+    if (latest[0][0], latest[0][1]) > (last_gen, last_index):
+        last_gen, last_index, ignored = latest[0]
     earliest_gen, earliest_index, ignored = latest[-1]
     feed_items = _update_feed_items(latest, request.application_url)
 
@@ -248,10 +255,13 @@ def oldest_chirps(request):
     created_by = authenticated_userid(request)
     user = users[created_by]
     if user_chirps != 'True':
-        follows = list(user.follows) + [created_by]
+        follows = set(user.follows)
+        follows.add(created_by)
+        reader = created_by
     else:
         userid = request.params.get('userid')
         follows = [userid]
+        reader = None
 
     if older_than is None:
         return -1, -1, ()
@@ -260,7 +270,7 @@ def oldest_chirps(request):
     earliest_gen = long(earliest_gen)
     earliest_index = int(earliest_index)
     older = list(islice(chirps.older(earliest_gen, earliest_index,
-                                     follows), 20))
+                                     follows, reader), 20))
 
     if not older:
         return (earliest_gen, earliest_index, ())
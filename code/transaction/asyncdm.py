@@ -0,0 +1,84 @@
+import threading
+import transaction
+
+from paralleldm import ThreadPool
+
+class AsyncTransaction(object):
+    """A transaction that is committed and aborted on an I/O thread.
+
+    Committing a transaction pickles the changed data and writes it to
+    disk, or runs the queued SQL, in the thread that calls commit. A server
+    built around an event loop can't wait for that without stalling every
+    other request, so an AsyncTransaction only submits the commit to a
+    dedicated I/O thread and returns a Future for it:
+
+        t = AsyncTransaction()
+        dm = PickleDataManager(storage=storage)
+        t.join(dm)
+        dm['task'] = task
+        t.commit().add_done_callback(committed)
+
+    The callback gets the future, whose result() raises if the commit
+    failed. It runs on the I/O thread, so it should only hand the result
+    back to the event loop, for example with the loop's own thread safe
+    call. As with any transaction, a commit that failed still has to be
+    aborted.
+
+    Every AsyncTransaction has a transaction manager of its own instead of
+    using the thread's, so one thread can have as many of them in flight as
+    it likes. Their data managers must not be shared: give each transaction
+    its own PickleDataManager, over a SharedStorage of its own so they
+    don't all load the file again, and leave it alone until the commit is
+    done. Loading a data manager over a SharedStorage waits for a commit
+    that is writing the same file, so an event loop should create it on
+    the I/O thread too, with default_io().submit. SQLite connections have
+    to be opened with check_same_thread=False, since they are used from
+    both threads.
+
+    All the transactions are committed one after the other on the same
+    thread, so they take the file locks in turn and never wait for each
+    other.
+    """
+
+    def __init__(self, io=None):
+        self.manager = transaction.TransactionManager()
+        self.transaction = self.manager.begin()
+        self.io = io or default_io()
+
+    def join(self, resource):
+        resource.transaction_manager = self.manager
+        self.transaction.join(resource)
+
+    def note(self, text):
+        self.transaction.note(text)
+
+    def savepoint(self, optimistic=False):
+        return self.transaction.savepoint(optimistic)
+
+    def commit(self):
+        """Commit on the I/O thread and return a Future for it."""
+        return self.io.submit(self.transaction.commit)
+
+    def abort(self):
+        """Abort on the I/O thread and return a Future for it."""
+        return self.io.submit(self.transaction.abort)
+
+
+_default_io = None
+_default_io_lock = threading.Lock()
+
+def default_io():
+    """Return the I/O thread shared by the transactions of this process.
+
+    It can run other blocking calls too, like loading a data manager:
+
+        default_io().submit(PickleDataManager, path)
+    """
+    global _default_io
+    _default_io_lock.acquire()
+    try:
+        if _default_io is None:
+            _default_io = ThreadPool(threads=1)
+        return _default_io
+    finally:
+        _default_io_lock.release()
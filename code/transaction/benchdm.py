@@ -0,0 +1,278 @@
+"""Rough timings for the sample data managers.
+
+Run it from this directory, with a Python that has the transaction package
+installed::
+
+    $ python benchdm.py
+"""
+import os
+import pickle
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import transaction
+
+from asyncdm import AsyncTransaction
+from paralleldm import ParallelDataManager
+from pickledm import CompressedSerializer
+from pickledm import MarshalSerializer
+from pickledm import PickleDataManager
+from pickledm import PickleSerializer
+from pickledm import PickleStorage
+from sqlitedm import SQLiteDataManager
+from storages import GroupCommitStorage
+from storages import JournalStorage
+from storages import RecordStorage
+from storages import SharedStorage
+
+SIZES = (1000, 10000, 100000)
+SERIALIZERS = (None, PickleSerializer(), MarshalSerializer(),
+               CompressedSerializer(PickleSerializer()),
+               CompressedSerializer(MarshalSerializer()))
+
+def task(i):
+    return {'task_description': 'Task number %d' % i, 'task_completed': False}
+
+def populate(path, size, storage=PickleStorage):
+    dm = PickleDataManager(storage=storage(path))
+    t = transaction.begin()
+    t.join(dm)
+    for i in range(size):
+        dm['task%d' % i] = task(i)
+    t.commit()
+
+def bench_savepoints(path, batches=1000, batch_size=10):
+    """Take a savepoint per batch of changes, then roll back to each of them.
+
+    Returns the average cost of taking and of rolling back a savepoint.
+    """
+    dm = PickleDataManager(path)
+    t = transaction.begin()
+    t.join(dm)
+    savepoints = []
+    start = time.time()
+    for batch in range(batches):
+        savepoints.append(t.savepoint())
+        for i in range(batch_size):
+            dm['task%d' % (batch * batch_size + i)] = task(i)
+    taken = time.time() - start
+    start = time.time()
+    for savepoint in reversed(savepoints):
+        savepoint.rollback()
+    rolled_back = time.time() - start
+    t.abort()
+    return taken / batches, rolled_back / batches
+
+def bench_lookups(path, size, storage, lookups=100):
+    """Load the data and look up a few random keys.
+
+    Returns the time it took to load the data and the average cost of a
+    lookup.
+    """
+    names = ['task%d' % i for i in random.Random(size).sample(range(size),
+                                                             lookups)]
+    start = time.time()
+    dm = PickleDataManager(storage=storage(path))
+    loaded = time.time() - start
+    start = time.time()
+    for name in names:
+        dm[name]
+    looked_up = time.time() - start
+    return loaded, looked_up / lookups
+
+def bench_threads(path, storage, threads=8, commits=50):
+    """Commit a change to a key of its own from each of a few threads.
+
+    Returns the number of commits per second.
+    """
+    def commit(thread):
+        manager = transaction.TransactionManager()
+        for i in range(commits):
+            dm = PickleDataManager(storage=storage(JournalStorage(path)))
+            dm.transaction_manager = manager
+            t = manager.begin()
+            t.join(dm)
+            dm['thread%d' % thread] = i
+            t.commit()
+    workers = [threading.Thread(target=commit, args=(thread,))
+               for thread in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * commits / (time.time() - start)
+
+def bench_sqlite(path, rows, queued):
+    """Insert rows into a SQLite table in a single transaction, one
+    statement at a time or queued.
+
+    Returns the number of rows inserted per second.
+    """
+    connection = sqlite3.connect(path, isolation_level=None)
+    connection.execute("create table tasks (id, description, completed)")
+    dm = SQLiteDataManager(connection)
+    add = queued and dm.queue or dm.execute
+    start = time.time()
+    t = transaction.begin()
+    t.join(dm)
+    for i in range(rows):
+        add("insert into tasks values (?, ?, ?)", (i, 'Task number %d' % i,
+                                                   False))
+    t.commit()
+    elapsed = time.time() - start
+    connection.close()
+    return rows / elapsed
+
+def bench_managers(paths, parallel, commits=20):
+    """Change a key in each of several journals in every transaction.
+
+    Returns the average time a commit took.
+    """
+    dms = [PickleDataManager(storage=JournalStorage(path)) for path in paths]
+    start = time.time()
+    for i in range(commits):
+        t = transaction.begin()
+        if parallel:
+            t.join(ParallelDataManager(dms))
+        else:
+            for dm in dms:
+                t.join(dm)
+        for dm in dms:
+            dm['task0'] = task(i)
+        t.commit()
+    return (time.time() - start) / commits
+
+def bench_serializer(size, serializer, repeat=3):
+    """Encode and decode a dictionary of to-do tasks, with a serializer or
+    the default pickle protocol the storages use without one.
+
+    Returns the size of the encoded data and the average time it took to
+    encode and to decode it.
+    """
+    data = dict(('task%d' % i, task(i)) for i in range(size))
+    if serializer is None:
+        dumps, loads = pickle.dumps, pickle.loads
+    else:
+        dumps, loads = serializer.dumps, serializer.loads
+    start = time.time()
+    for i in range(repeat):
+        encoded = dumps(data)
+    encoding = (time.time() - start) / repeat
+    start = time.time()
+    for i in range(repeat):
+        loads(encoded)
+    decoding = (time.time() - start) / repeat
+    return len(encoded), encoding, decoding
+
+def bench_async(path, asynchronous, commits=200):
+    """Commit a change to a journal in every transaction, waiting for each
+    commit or only submitting it to the I/O thread.
+
+    Returns the average time the committing thread was blocked, and how
+    long all the commits took. Every data manager gets a SharedStorage of
+    its own, and loading it counts as blocked time too, since it can wait
+    for a commit in progress.
+    """
+    futures = []
+    blocked = 0
+    start = time.time()
+    for i in range(commits):
+        submitted = time.time()
+        if asynchronous:
+            t = AsyncTransaction()
+        else:
+            t = transaction.begin()
+        dm = PickleDataManager(storage=SharedStorage(JournalStorage(path)))
+        t.join(dm)
+        dm['task%d' % (i % 100)] = task(i)
+        futures.append(t.commit())
+        blocked += time.time() - submitted
+    for future in futures:
+        if future is not None:
+            future.result()
+    return blocked / commits, time.time() - start
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        print('%10s %16s %16s' % ('items', 'savepoint (us)', 'rollback (us)'))
+        for size in SIZES:
+            path = os.path.join(directory, 'Data%d.pkl' % size)
+            populate(path, size)
+            taken, rolled_back = bench_savepoints(path)
+            print('%10d %16.1f %16.1f' % (size, taken * 1e6,
+                                          rolled_back * 1e6))
+        print('')
+        print('%10s %14s %16s %16s' % ('items', 'storage', 'load (ms)',
+                                       'lookup (us)'))
+        for size in SIZES:
+            for storage in (PickleStorage, RecordStorage):
+                path = os.path.join(directory, '%s%d' % (storage.__name__,
+                                                         size))
+                populate(path, size, storage)
+                loaded, looked_up = bench_lookups(path, size, storage)
+                print('%10d %14s %16.1f %16.1f' % (size, storage.__name__,
+                                                   loaded * 1e3,
+                                                   looked_up * 1e6))
+        print('')
+        print('%10s %20s %16s' % ('threads', 'storage', 'commits/s'))
+        for threads in (1, 4, 16):
+            for storage in (SharedStorage, GroupCommitStorage):
+                path = os.path.join(directory, '%s%d' % (storage.__name__,
+                                                         threads))
+                print('%10d %20s %16.1f' % (threads, storage.__name__,
+                                            bench_threads(path, storage,
+                                                          threads)))
+        print('')
+        print('%10s %16s %16s' % ('rows', 'execute rows/s', 'queue rows/s'))
+        for size in SIZES:
+            executed = bench_sqlite(os.path.join(directory, 'e%d.db' % size),
+                                    size, False)
+            queued = bench_sqlite(os.path.join(directory, 'q%d.db' % size),
+                                  size, True)
+            print('%10d %16.1f %16.1f' % (size, executed, queued))
+        print('')
+        print('%10s %10s %16s %16s' % ('managers', 'items', 'serial (ms)',
+                                       'parallel (ms)'))
+        for managers in (1, 4):
+            for size in SIZES[:2]:
+                paths = [os.path.join(directory, 'm%d_%d_%d.pkl' % (
+                    managers, size, i)) for i in range(managers)]
+                for path in paths:
+                    populate(path, size, JournalStorage)
+                serial = bench_managers(paths, False)
+                parallel = bench_managers(paths, True)
+                print('%10d %10d %16.1f %16.1f' % (managers, size,
+                                                   serial * 1e3,
+                                                   parallel * 1e3))
+        print('')
+        print('%10s %14s %12s %16s %16s' % ('items', 'serializer', 'bytes',
+                                            'encode (ms)', 'decode (ms)'))
+        for size in SIZES:
+            for serializer in SERIALIZERS:
+                encoded, encoding, decoding = bench_serializer(size,
+                                                               serializer)
+                print('%10d %14s %12d %16.1f %16.1f' % (
+                    size, serializer and serializer.name or 'default',
+                    encoded, encoding * 1e3, decoding * 1e3))
+        print('')
+        print('%10s %14s %16s %16s' % ('items', 'commit', 'blocked (ms)',
+                                       'total (ms)'))
+        for size in SIZES[:2]:
+            for asynchronous in (False, True):
+                path = os.path.join(directory, 'a%d_%d.pkl' % (size,
+                                                               asynchronous))
+                populate(path, size, JournalStorage)
+                blocked, total = bench_async(path, asynchronous)
+                print('%10d %14s %16.2f %16.1f' % (
+                    size, asynchronous and 'asynchronous' or 'synchronous',
+                    blocked * 1e3, total * 1e3))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+"""Repeatable benchmarks for the sample data managers.
+
+Every benchmark is run a few times, after a warmup, with enough loops to
+last a while each time, and the time per loop of every run is kept. The
+results can be saved as JSON and compared with those of another
+revision::
+
+    $ python benchsuite.py --output before.json
+    $ python benchsuite.py --output after.json
+    $ python benchsuite.py --compare before.json after.json
+
+Everything runs in a temporary directory, and all the data is generated
+from fixed seeds, so two runs on the same machine do the same work.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import transaction
+
+from benchdm import populate
+from benchdm import task
+from paralleldm import ParallelDataManager
+from pickledm import PickleDataManager
+from pickledm import PickleStorage
+from sqlitedm import SQLiteCoordinator
+from sqlitedm import SQLiteDataManager
+from storages import JournalStorage
+from storages import RecordStorage
+
+SIZES = (1000, 10000, 100000)
+STORAGES = (PickleStorage, JournalStorage, RecordStorage)
+
+def sqlite_database(path, size):
+    connection = sqlite3.connect(path, isolation_level=None)
+    connection.execute("create table tasks (id integer primary key, "
+                       "description, completed)")
+    connection.execute("begin")
+    connection.executemany("insert into tasks values (?, ?, ?)",
+                           [(i, 'Task number %d' % i, False)
+                            for i in range(size)])
+    connection.execute("commit")
+    return connection
+
+def bench_commit(path, storage):
+    dm = PickleDataManager(storage=storage(path))
+    def run(loops):
+        start = time.time()
+        for i in range(loops):
+            t = transaction.begin()
+            t.join(dm)
+            dm['task%d' % (i % 100)] = task(i)
+            t.commit()
+        return time.time() - start
+    return run
+
+def bench_commit_sqlite(connection):
+    dm = SQLiteDataManager(connection)
+    def run(loops):
+        start = time.time()
+        for i in range(loops):
+            t = transaction.begin()
+            t.join(dm)
+            dm.execute("update tasks set completed = ? where id = ?",
+                       (i % 2 == 0, i % 100))
+            t.commit()
+        return time.time() - start
+    return run
+
+def bench_abort(path):
+    dm = PickleDataManager(path)
+    def run(loops):
+        start = time.time()
+        for i in range(loops):
+            t = transaction.begin()
+            t.join(dm)
+            for j in range(10):
+                dm['task%d' % j] = task(i)
+            t.abort()
+        return time.time() - start
+    return run
+
+def bench_abort_sqlite(connection):
+    dm = SQLiteDataManager(connection)
+    def run(loops):
+        start = time.time()
+        for i in range(loops):
+            t = transaction.begin()
+            t.join(dm)
+            for j in range(10):
+                dm.execute("update tasks set completed = 1 where id = ?",
+                           (j,))
+            t.abort()
+        return time.time() - start
+    return run
+
+def bench_savepoint(make_dm, write):
+    """Take a savepoint and change ten keys, then roll back, every loop."""
+    def run(loops):
+        dm = make_dm()
+        t = transaction.begin()
+        t.join(dm)
+        start = time.time()
+        for i in range(loops):
+            savepoint = t.savepoint()
+            for j in range(10):
+                write(dm, i * 10 + j)
+            savepoint.rollback()
+        elapsed = time.time() - start
+        t.abort()
+        return elapsed
+    return run
+
+def write_pickle(dm, i):
+    dm['task%d' % i] = task(i)
+
+def write_sqlite(dm, i):
+    dm.execute("update tasks set completed = 1 where id = ?", (i,))
+
+def bench_load(path, storage):
+    def run(loops):
+        start = time.time()
+        for i in range(loops):
+            PickleDataManager(storage=storage(path))
+        return time.time() - start
+    return run
+
+def bench_load_sqlite(path):
+    def run(loops):
+        start = time.time()
+        for i in range(loops):
+            connection = sqlite3.connect(path, isolation_level=None)
+            dm = SQLiteDataManager(connection)
+            dm.execute("select count(*) from tasks").fetchone()
+            connection.close()
+        return time.time() - start
+    return run
+
+def bench_managers(paths, parallel):
+    dms = [PickleDataManager(storage=JournalStorage(path)) for path in paths]
+    def run(loops):
+        start = time.time()
+        for i in range(loops):
+            t = transaction.begin()
+            if parallel:
+                t.join(ParallelDataManager(dms))
+            else:
+                for dm in dms:
+                    t.join(dm)
+            for dm in dms:
+                dm['task0'] = task(i)
+            t.commit()
+        return time.time() - start
+    return run
+
+def bench_coordinated(paths, journal_path):
+    coordinator = SQLiteCoordinator(journal_path)
+    dms = [SQLiteDataManager(sqlite3.connect(path, isolation_level=None),
+                             coordinator) for path in paths]
+    def run(loops):
+        start = time.time()
+        for i in range(loops):
+            t = transaction.begin()
+            for dm in dms:
+                t.join(dm)
+                dm.execute("update tasks set completed = ? where id = 0",
+                           (i % 2 == 0,))
+            t.commit()
+        return time.time() - start
+    return run
+
+def benchmarks(directory, sizes, only=None):
+    """Yield the name of every benchmark whose name contains only, and the
+    function that runs it a number of times.
+
+    The data a benchmark needs is set up right before it is yielded, and
+    only once, so skipped benchmarks don't set up anything.
+    """
+    ready = {}
+
+    def selected(name):
+        return not only or only in name
+
+    def pickle_data(size, storage=PickleStorage):
+        path = os.path.join(directory, '%s%d' % (storage.__name__, size))
+        if path not in ready:
+            populate(path, size, storage)
+            ready[path] = None
+        return path
+
+    def sqlite_data(size):
+        path = os.path.join(directory, 'SQLite%d.db' % size)
+        if path not in ready:
+            ready[path] = sqlite_database(path, size)
+        return path, ready[path]
+
+    def managers_data(managers):
+        paths = [os.path.join(directory, 'managers%d_%d' % (managers, i))
+                 for i in range(managers)]
+        for path in paths:
+            if path not in ready:
+                populate(path, 1000, JournalStorage)
+                ready[path] = None
+        return paths
+
+    for size in sizes:
+        for storage in STORAGES:
+            name = 'load_%s_%d' % (storage.__name__, size)
+            if selected(name):
+                yield name, bench_load(pickle_data(size, storage), storage)
+            name = 'commit_%s_%d' % (storage.__name__, size)
+            if selected(name):
+                yield name, bench_commit(pickle_data(size, storage), storage)
+        name = 'abort_PickleStorage_%d' % size
+        if selected(name):
+            yield name, bench_abort(pickle_data(size))
+        name = 'load_SQLite_%d' % size
+        if selected(name):
+            yield name, bench_load_sqlite(sqlite_data(size)[0])
+        name = 'commit_SQLite_%d' % size
+        if selected(name):
+            yield name, bench_commit_sqlite(sqlite_data(size)[1])
+        name = 'abort_SQLite_%d' % size
+        if selected(name):
+            yield name, bench_abort_sqlite(sqlite_data(size)[1])
+    size = sizes[-1]
+    name = 'savepoint_PickleStorage_%d' % size
+    if selected(name):
+        path = pickle_data(size)
+        yield name, bench_savepoint(lambda: PickleDataManager(path),
+                                    write_pickle)
+    name = 'savepoint_SQLite_%d' % size
+    if selected(name):
+        connection = sqlite3.connect(sqlite_data(size)[0],
+                                     isolation_level=None)
+        yield name, bench_savepoint(lambda: SQLiteDataManager(connection),
+                                    write_sqlite)
+    for managers in (2, 4):
+        name = 'tpc_serial_%d' % managers
+        if selected(name):
+            yield name, bench_managers(managers_data(managers), False)
+        name = 'tpc_parallel_%d' % managers
+        if selected(name):
+            yield name, bench_managers(managers_data(managers), True)
+        name = 'tpc_SQLite_%d' % managers
+        if selected(name):
+            paths = [os.path.join(directory,
+                                  'coordinated%d_%d.db' % (managers, i))
+                     for i in range(managers)]
+            for path in paths:
+                sqlite_database(path, 1000).close()
+            yield name, bench_coordinated(paths, os.path.join(
+                directory, 'coordinator%d.db' % managers))
+
+def calibrate(run, min_time):
+    """Return the number of loops that takes at least min_time seconds."""
+    loops = 1
+    while loops < 2 ** 20:
+        if run(loops) >= min_time:
+            break
+        loops *= 2
+    return loops
+
+def measure(run, runs, warmups, min_time):
+    loops = calibrate(run, min_time)
+    for i in range(warmups):
+        run(loops)
+    return loops, [run(loops) / loops for i in range(runs)]
+
+def revision():
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        output = process.communicate()[0]
+    except OSError:
+        return None
+    return output.strip() or None
+
+def metadata():
+    return {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'revision': revision(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def mean(values):
+    return sum(values) / len(values)
+
+def stdev(values):
+    if len(values) < 2:
+        return 0.0
+    average = mean(values)
+    return math.sqrt(sum([(value - average) ** 2 for value in values]) /
+                     (len(values) - 1))
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * scale >= 1:
+            return '%.2f %s' % (seconds * scale, unit)
+    return '%.2f ns' % (seconds * 1e9)
+
+def run_suite(sizes, runs, warmups, min_time, only=None):
+    results = {'metadata': metadata(), 'benchmarks': {}}
+    directory = tempfile.mkdtemp()
+    try:
+        for name, run in benchmarks(directory, sizes, only):
+            loops, values = measure(run, runs, warmups, min_time)
+            results['benchmarks'][name] = {'loops': loops, 'values': values}
+            print('%-32s %12s +- %s' % (name, format_time(mean(values)),
+                                        format_time(stdev(values))))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def compare(old, new):
+    """Print the benchmarks of two results side by side.
+
+    A change is only flagged when the means are further apart than twice
+    the larger standard deviation.
+    """
+    print('%-32s %12s %12s %14s' % ('benchmark', 'old', 'new', 'change'))
+    for name in sorted(old['benchmarks']):
+        if name not in new['benchmarks']:
+            continue
+        before = old['benchmarks'][name]['values']
+        after = new['benchmarks'][name]['values']
+        difference = mean(after) - mean(before)
+        noise = 2 * max(stdev(before), stdev(after))
+        if abs(difference) <= noise:
+            change = 'same'
+        else:
+            change = '%.2fx %s' % (max(mean(after), mean(before)) /
+                                   min(mean(after), mean(before)),
+                                   difference < 0 and 'faster' or 'slower')
+        print('%-32s %12s %12s %14s' % (name, format_time(mean(before)),
+                                       format_time(mean(after)), change))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', help="save the results to a JSON file")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help="compare two JSON result files")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--warmups', type=int, default=1)
+    parser.add_argument('--min-time', type=float, default=0.1,
+                        help="seconds each run should last at least")
+    parser.add_argument('--quick', action='store_true',
+                        help="skip the largest data size")
+    parser.add_argument('--only', help="run the benchmarks whose name "
+                        "contains this")
+    options = parser.parse_args(argv)
+    if options.compare:
+        old, new = [json.load(open(path)) for path in options.compare]
+        compare(old, new)
+        return
+    sizes = options.quick and SIZES[:-1] or SIZES
+    results = run_suite(sizes, options.runs, options.warmups,
+                        options.min_time, options.only)
+    if options.output:
+        output = open(options.output, 'w')
+        try:
+            json.dump(results, output, indent=2, sort_keys=True)
+        finally:
+            output.close()
+
+if __name__ == '__main__':
+    main()
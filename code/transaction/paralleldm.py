@@ -0,0 +1,273 @@
+import atexit
+import sys
+import threading
+import traceback
+import Queue
+
+class ParallelDataManager(object):
+    """Join several data managers to a transaction as one.
+
+    The transaction package calls tpc_vote on one data manager after the
+    other, so a transaction with several slow data managers, like pickle
+    files on different disks or several databases, takes as long to vote
+    as all of them added up. Joined through a ParallelDataManager instead,
+    they vote at the same time on the threads of a pool, which takes about
+    as long as the slowest of them:
+
+        t.join(ParallelDataManager([dm1, dm2, dm3]))
+
+    Data managers that need to vote in the order of their sort keys, for
+    example because they take the same locks, can be passed in ``ordered``.
+    They vote one after the other, still at the same time as the rest.
+    With ``finish`` true, tpc_finish is run in parallel too. Everything
+    else is called in sort key order, as the transaction would.
+
+    Data managers that commit while voting, and so have to vote last, say
+    so with a true ``commits_in_vote`` attribute. They only vote after all
+    the others have voted, one after the other, and the parallel data
+    manager takes the largest sort key and commits in its vote too.
+
+    The data managers are called from other threads, so they must not be
+    tied to the thread that uses them. SQLite connections, for example,
+    have to be opened with check_same_thread=False.
+    """
+
+    def __init__(self, resources, ordered=(), pool=None, finish=False):
+        self.resources = sorted(list(resources) + list(ordered),
+                                key=lambda resource: resource.sortKey())
+        self.ordered = [resource for resource in self.resources
+                        if resource in ordered]
+        self.last = [resource for resource in self.resources
+                     if getattr(resource, 'commits_in_vote', False)]
+        self.pool = pool or default_pool()
+        self.parallel_finish = finish
+
+    @property
+    def commits_in_vote(self):
+        return bool(self.last)
+
+    def lanes(self, method):
+        if method == 'tpc_vote':
+            # the ones that commit while voting come after all the lanes
+            resources = [resource for resource in self.resources
+                         if resource not in self.last]
+        else:
+            resources = self.resources
+        lanes = [[resource] for resource in resources
+                 if resource not in self.ordered]
+        ordered = [resource for resource in self.ordered
+                   if resource in resources]
+        if ordered:
+            lanes.append(ordered)
+        return lanes
+
+    def call(self, method, transaction):
+        errors = []
+        for resource in self.resources:
+            try:
+                getattr(resource, method)(transaction)
+            except:
+                errors.append(sys.exc_info())
+        if errors:
+            error_type, error, traceback = errors[0]
+            raise error_type, error, traceback
+
+    def run(self, method, transaction):
+        def lane(resources):
+            for resource in resources:
+                getattr(resource, method)(transaction)
+        lanes = self.lanes(method)
+        if len(lanes) == 1:
+            return lane(lanes[0])
+        futures = [self.pool.submit(lane, resources) for resources in lanes]
+        # wait for all of them, so none is still voting when we abort
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except:
+                errors.append(sys.exc_info())
+        if errors:
+            error_type, error, traceback = errors[0]
+            raise error_type, error, traceback
+
+    def abort(self, transaction):
+        self.call('abort', transaction)
+
+    def tpc_begin(self, transaction):
+        for resource in self.resources:
+            resource.tpc_begin(transaction)
+
+    def commit(self, transaction):
+        for resource in self.resources:
+            resource.commit(transaction)
+
+    def tpc_vote(self, transaction):
+        self.run('tpc_vote', transaction)
+        for resource in self.last:
+            resource.tpc_vote(transaction)
+
+    def tpc_finish(self, transaction):
+        if self.parallel_finish:
+            self.run('tpc_finish', transaction)
+        else:
+            for resource in self.resources:
+                resource.tpc_finish(transaction)
+
+    def tpc_abort(self, transaction):
+        self.call('tpc_abort', transaction)
+
+    def sortKey(self):
+        if self.last:
+            return self.resources[-1].sortKey()
+        return self.resources[0].sortKey()
+
+    def savepoint(self):
+        return ParallelSavepoint([resource.savepoint()
+                                  for resource in self.resources])
+
+
+class ParallelSavepoint(object):
+
+    def __init__(self, savepoints):
+        self.savepoints = savepoints
+
+    def rollback(self):
+        for savepoint in self.savepoints:
+            savepoint.rollback()
+
+
+class Future(object):
+    """The result of a call made on another thread."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def set_result(self, value):
+        self.value = value
+        self.finish()
+
+    def set_error(self, error):
+        self.error = error
+        self.finish()
+
+    def finish(self):
+        self.lock.acquire()
+        try:
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        finally:
+            self.lock.release()
+        for callback in callbacks:
+            self.run_callback(callback)
+
+    def run_callback(self, callback):
+        try:
+            callback(self)
+        except:
+            traceback.print_exc()
+
+    def add_done_callback(self, callback):
+        """Call callback with this future once the call has finished, or
+        right away if it already has.
+
+        The callback runs on the thread that made the call, so an event
+        loop should use it to schedule its own work, not to do it.
+        """
+        self.lock.acquire()
+        try:
+            if not self.event.isSet():
+                self.callbacks.append(callback)
+                return
+        finally:
+            self.lock.release()
+        self.run_callback(callback)
+
+    def done(self):
+        return self.event.isSet()
+
+    def result(self, timeout=None):
+        """Wait for the call to finish and return what it returned, or
+        raise what it raised."""
+        self.event.wait(timeout)
+        if not self.event.isSet():
+            raise RuntimeError("The call has not finished yet")
+        if self.error is not None:
+            error_type, error, traceback = self.error
+            raise error_type, error, traceback
+        return self.value
+
+
+class ThreadPool(object):
+    """Run calls on a fixed number of worker threads.
+
+    The threads are started when the first call is submitted and keep
+    running until the process exits.
+    """
+
+    def __init__(self, threads=8):
+        self.threads = threads
+        self.calls = Queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            if not self.workers:
+                atexit.register(self.stop)
+            while len(self.workers) < self.threads:
+                worker = threading.Thread(target=self.work)
+                worker.setDaemon(True)
+                worker.start()
+                self.workers.append(worker)
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        """Stop the threads once they are done with the calls submitted."""
+        self.lock.acquire()
+        try:
+            workers, self.workers = self.workers, []
+        finally:
+            self.lock.release()
+        for worker in workers:
+            self.calls.put(None)
+        for worker in workers:
+            worker.join()
+
+    def work(self):
+        while True:
+            call = self.calls.get()
+            if call is None:
+                return
+            future, function, args = call
+            try:
+                future.set_result(function(*args))
+            except:
+                future.set_error(sys.exc_info())
+
+    def submit(self, function, *args):
+        if len(self.workers) < self.threads:
+            self.start()
+        future = Future()
+        self.calls.put((future, function, args))
+        return future
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def default_pool():
+    global _default_pool
+    _default_pool_lock.acquire()
+    try:
+        if _default_pool is None:
+            _default_pool = ThreadPool()
+        return _default_pool
+    finally:
+        _default_pool_lock.release()
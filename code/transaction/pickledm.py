@@ -1,49 +1,122 @@
+import heapq
+import itertools
+import marshal
 import os
 import pickle
+import tempfile
+import threading
 import transaction
+import zlib
+
+from transaction.interfaces import TransientError
+
+try:
+    import cPickle
+except ImportError:
+    cPickle = pickle
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 class PickleDataManager(object):
 
     transaction_manager = transaction.manager
 
-    def __init__(self, pickle_path='Data.pkl'):
-        self.pickle_path = pickle_path
-        try:
-            data_file = open(self.pickle_path, 'rb')
-        except IOError:
-            data_file = None
-        uncommitted = {}
-        if data_file is not None:
-            try:
-                uncommitted = pickle.load(data_file)
-            except EOFError:
-                pass
-        self.uncommitted = uncommitted
-        self.committed = uncommitted.copy()
+    def __init__(self, pickle_path='Data.pkl', storage=None, serializer=None):
+        if storage is None:
+            storage = PickleStorage(pickle_path, serializer)
+        self.storage = storage
+        self.pickle_path = storage.pickle_path
+        self.committed = storage.load()
+        self.uncommitted = {}
+        self.savepoints = []
 
     def __getitem__(self, name):
-        return self.uncommitted[name]
+        value = self.uncommitted.get(name, _MISSING)
+        if value is _DELETED:
+            raise KeyError(name)
+        if value is _MISSING:
+            return self.committed[name]
+        return value
 
     def __setitem__(self, name, value):
+        self.changing(name)
         self.uncommitted[name] = value
 
     def __delitem__(self, name):
-        del self.uncommitted[name]
+        if name not in self:
+            raise KeyError(name)
+        self.changing(name)
+        self.uncommitted[name] = _DELETED
+
+    def __contains__(self, name):
+        value = self.uncommitted.get(name, _MISSING)
+        if value is _MISSING:
+            return name in self.committed
+        return value is not _DELETED
 
     def keys(self):
-        return self.uncommitted.keys()
+        changes = self.uncommitted
+        if not changes:
+            return self.committed.keys()
+        keys = [name for name in self.committed.keys() if name not in changes]
+        keys.extend([name for name, value in changes.items()
+                     if value is not _DELETED])
+        return keys
 
     def values(self):
-        return self.uncommitted.values()
+        return [value for name, value in self.items()]
 
-    def items(self):
-        return self.uncommitted.items()
+    def items(self, sorted=False, start=0, limit=None, min=None, max=None):
+        changes = self.uncommitted
+        if (sorted or start or limit is not None or min is not None
+                or max is not None):
+            if changes:
+                items = itertools.islice(self.sorted_items(min, max), start,
+                                         None)
+            else:
+                items = ((name, self.committed[name]) for name in
+                         sorted_keys(self.committed, min, max, start))
+            return list(itertools.islice(items, limit))
+        if not changes:
+            return self.committed.items()
+        items = [(name, value) for name, value in self.committed.items()
+                 if name not in changes]
+        items.extend([(name, value) for name, value in changes.items()
+                      if value is not _DELETED])
+        return items
+
+    def sorted_items(self, min=None, max=None):
+        changes = self.uncommitted
+        added = [name for name, value in changes.items()
+                 if value is not _DELETED and in_range(name, min, max)]
+        added.sort()
+        previous = _MISSING
+        for name in heapq.merge(sorted_keys(self.committed, min, max), added):
+            if name == previous:
+                continue
+            previous = name
+            value = changes.get(name, _MISSING)
+            if value is _MISSING:
+                yield name, self.committed[name]
+            elif value is not _DELETED:
+                yield name, value
 
     def __repr__(self):
-        return self.uncommitted.__repr__()
+        return dict(self.items()).__repr__()
+
+    def changing(self, name):
+        if self.savepoints:
+            undo = self.savepoints[-1]
+            if name not in undo:
+                undo[name] = self.uncommitted.get(name, _MISSING)
 
     def abort(self, transaction):
-        self.uncommitted = self.committed.copy()
+        self.uncommitted = {}
+        self.savepoints = []
 
     def tpc_begin(self, transaction):
         pass
@@ -52,23 +125,30 @@ class PickleDataManager(object):
         pass
 
     def tpc_vote(self, transaction):
-        devnull = open(os.devnull, 'wb')
-        try:
-            pickle.dump(self.uncommitted, devnull)
-        except (TypeError, pickle.PicklingError):
-            raise ValueError("Unpickleable value cannot be saved")
+        if self.uncommitted:
+            self.storage.vote(self.committed, self.uncommitted)
 
     def tpc_finish(self, transaction):
-        data_file = open(self.pickle_path, 'wb')
-        pickle.dump(self.uncommitted, data_file)
-        self.committed = self.uncommitted.copy()
+        if self.uncommitted:
+            self.storage.finish(self.committed, self.uncommitted)
+        self.uncommitted = {}
+        self.savepoints = []
 
     def tpc_abort(self, transaction):
-        self.uncommitted = self.committed.copy()
+        self.storage.abort()
+        self.uncommitted = {}
+        self.savepoints = []
 
     def sortKey(self):
         return 'pickledm' + str(id(self))
 
+    def transaction_size(self):
+        """Return the number of keys changed by the transaction that is
+        being committed and the number of bytes the storage wrote for it."""
+        if not self.uncommitted:
+            return 0, 0
+        return len(self.uncommitted), self.storage.written
+
     def savepoint(self):
         return PickleSavepoint(self)
 
@@ -76,9 +156,377 @@ class PickleDataManager(object):
 class PickleSavepoint(object):
 
     def __init__(self, dm):
-        self.dm = dm 
-        self.saved_committed = self.dm.uncommitted.copy()
+        self.dm = dm
+        self.dm.savepoints.append({})
+        self.depth = len(self.dm.savepoints)
 
     def rollback(self):
-        self.dm.uncommitted = self.saved_committed.copy()
+        savepoints = self.dm.savepoints
+        uncommitted = self.dm.uncommitted
+        while len(savepoints) >= self.depth:
+            undo = savepoints.pop()
+            for name, value in undo.items():
+                if value is _MISSING:
+                    del uncommitted[name]
+                else:
+                    uncommitted[name] = value
+        savepoints.append({})
+
+
+# Markers used in the uncommitted dictionary, which only holds the changes
+# made by the current transaction on top of the committed data.
+_DELETED = object()
+_MISSING = object()
+
+def in_range(name, min, max):
+    return (min is None or name >= min) and (max is None or name <= max)
+
+def sorted_keys(data, min=None, max=None, start=0):
+    """Iterate over the keys of data in order, skipping the first start.
+
+    Data that keeps its keys sorted, like the OrderedData of an
+    OrderedStorage, has them in a sorted_keys attribute; for anything else
+    the keys are sorted on the spot.
+    """
+    keys = getattr(data, 'sorted_keys', None)
+    if keys is not None:
+        return keys.iterate(min, max, start)
+    names = [name for name in data.keys() if in_range(name, min, max)]
+    names.sort()
+    return iter(names[start:])
+
+def apply_changes(data, changes):
+    for name, value in changes.items():
+        if value is _DELETED:
+            data.pop(name, None)
+        else:
+            data[name] = value
+
+def changes_between(old, new):
+    """Return the changes that turn the old dictionary into the new one.
+
+    Values are compared with ==.
+    """
+    changes = {}
+    for name, value in new.items():
+        if old.get(name, _MISSING) != value:
+            changes[name] = value
+    for name in old.keys():
+        if name not in new:
+            changes[name] = _DELETED
+    return changes
+
+def merge_changes(committed, external, changes):
+    """Apply changes committed by somebody else to our committed data.
+
+    Raise a ConflictError if any of them touches a key in changes.
+    """
+    apply_changes(committed, external)
+    conflicts = [name for name in changes if name in external]
+    if conflicts:
+        raise ConflictError("Conflicting changes to %s" %
+                            ', '.join([repr(name) for name in conflicts]),
+                            external)
+    return external
+
+
+class ConflictError(TransientError):
+    """Another process committed changes to the same keys first.
+
+    This is a transient error, so the transaction can just be retried. The
+    changes of the other process have been merged into the committed data
+    anyway, and are kept in the changes attribute.
+    """
+
+    def __init__(self, message, changes):
+        TransientError.__init__(self, message)
+        self.changes = changes
+
+
+class FileLock(object):
+    """Exclusive lock on a file, shared by the processes using a storage.
+
+    Storages hold it from tpc_vote until tpc_finish or tpc_abort, to
+    compare their generation with the one on disk and write theirs.
+
+    The lock is taken on a file descriptor of its own, so a thread that
+    already holds it for another storage of the same file would wait for
+    itself forever. That happens when two data managers for one file join
+    the same transaction, and raises a ValueError instead.
+    """
+
+    # the thread holding the lock of each path in this process
+    holders = {}
+    holders_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.key = os.path.abspath(path)
+        self.lock_file = None
+
+    def acquire(self):
+        if self.lock_file is not None:
+            return
+        self.holders_lock.acquire()
+        try:
+            if self.holders.get(self.key) is threading.current_thread():
+                raise ValueError("%s is already locked by this thread" %
+                                 self.path)
+        finally:
+            self.holders_lock.release()
+        lock_file = open(self.path, 'a+b')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        except:
+            lock_file.close()
+            raise
+        self.lock_file = lock_file
+        self.holders_lock.acquire()
+        try:
+            self.holders[self.key] = threading.current_thread()
+        finally:
+            self.holders_lock.release()
+
+    def release(self):
+        lock_file = self.lock_file
+        if lock_file is None:
+            return
+        self.lock_file = None
+        self.holders_lock.acquire()
+        try:
+            self.holders.pop(self.key, None)
+        finally:
+            self.holders_lock.release()
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            lock_file.close()
+
+
+def load_versioned(path, default, data=True):
+    """Return the generation and data of a file written by dump_staged.
+
+    The generation is pickled on its own before the data, so it can be
+    read without loading the data, by passing a false data argument. Files
+    written before generations were introduced hold just the data and
+    count as generation 0.
+    """
+    try:
+        data_file = open(path, 'rb')
+    except IOError:
+        return 0, default
+    try:
+        try:
+            generation = pickle.load(data_file)
+            if not isinstance(generation, (int, long)):
+                return 0, generation
+            if not data:
+                return generation, None
+            value = pickle.load(data_file)
+            if isinstance(value, str):
+                # the data was written by the serializer with this name
+                return generation, get_serializer(value).loads(
+                    data_file.read())
+            return generation, value
+        except EOFError:
+            return 0, default
+    finally:
+        data_file.close()
+
+def dump_staged(objects, prefix, suffix='', payload=None):
+    """Pickle each of objects into a new file whose name starts with prefix,
+    followed by the payload string, if there is one.
+
+    The file is synced to disk before its path is returned. If the objects
+    can't be pickled, no file is left behind.
+    """
+    directory, name = os.path.split(os.path.abspath(prefix))
+    fd, path = tempfile.mkstemp(prefix=name, suffix=suffix, dir=directory)
+    data_file = os.fdopen(fd, 'wb')
+    try:
+        try:
+            for obj in objects:
+                pickle.dump(obj, data_file)
+            if payload is not None:
+                data_file.write(payload)
+            data_file.flush()
+            os.fsync(data_file.fileno())
+        finally:
+            data_file.close()
+    except (TypeError, pickle.PicklingError):
+        os.remove(path)
+        raise ValueError("Unpickleable value cannot be saved")
+    except EnvironmentError:
+        os.remove(path)
+        raise
+    return path
+
+class PickleSerializer(object):
+    """Serialize with cPickle and the highest pickle protocol.
+
+    The binary protocol is several times faster than the text protocol
+    pickle uses by default, and its output is smaller.
+    """
+
+    name = 'pickle'
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        self.protocol = protocol
+
+    def dumps(self, obj):
+        try:
+            return cPickle.dumps(obj, self.protocol)
+        except (TypeError, pickle.PicklingError, cPickle.PicklingError):
+            raise ValueError("Unpickleable value cannot be saved")
+
+    def loads(self, data):
+        return cPickle.loads(data)
+
+
+class MarshalSerializer(object):
+    """Serialize with marshal, which is faster than pickle but only handles
+    plain data: dictionaries, lists, tuples, strings, numbers, booleans and
+    None, and not their subclasses. The format may change between Python
+    versions, so every process using the file must run the same one.
+    """
+
+    name = 'marshal'
+
+    def dumps(self, obj):
+        try:
+            return marshal.dumps(obj, 2)
+        except ValueError:
+            raise ValueError("Unmarshallable value cannot be saved")
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+
+class CompressedSerializer(object):
+    """Compress the output of another serializer with zlib."""
+
+    def __init__(self, serializer, level=6):
+        self.serializer = serializer
+        self.level = level
+        self.name = 'zlib:' + serializer.name
+
+    def dumps(self, obj):
+        return zlib.compress(self.serializer.dumps(obj), self.level)
+
+    def loads(self, data):
+        return self.serializer.loads(zlib.decompress(data))
+
+
+SERIALIZERS = {'pickle': PickleSerializer, 'marshal': MarshalSerializer}
+
+def get_serializer(name):
+    """Return a serializer that can read what the one with name wrote."""
+    if name.startswith('zlib:'):
+        return CompressedSerializer(get_serializer(name[len('zlib:'):]))
+    try:
+        return SERIALIZERS[name]()
+    except KeyError:
+        raise ValueError("Unknown serializer %r" % name)
+
+def file_signature(path):
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return info.st_ino, info.st_size, info.st_mtime
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def replace(source, target):
+    # os.rename only overwrites an existing file atomically on POSIX
+    if os.name == 'nt' and os.path.exists(target):
+        os.remove(target)
+    os.rename(source, target)
+
+
+class PickleStorage(object):
+    """Keep the whole dictionary in a single pickle file.
+
+    Every commit writes the complete dictionary to a temporary file while
+    voting, and renames it over the pickle file when the transaction
+    finishes, so a crash never leaves a half written pickle file behind.
+
+    The file also holds a generation number, which goes up with every
+    commit. Several processes can use the same file: while voting, a
+    storage locks the file and, if another process committed since the
+    data was loaded, merges those changes in first. If both changed the
+    same key, a ConflictError is raised and the transaction can be retried.
+
+    By default the data is pickled with the default protocol. A serializer,
+    like a PickleSerializer or a MarshalSerializer, can be passed to write
+    it faster and smaller. Its name is saved in the file, so the file can
+    be loaded whatever serializer the reader was given.
+    """
+
+    def __init__(self, pickle_path='Data.pkl', serializer=None):
+        self.pickle_path = pickle_path
+        self.serializer = serializer
+        self.lock = FileLock(pickle_path + '.lock')
+        self.generation = 0
+        self.staged = None
+        self.written = 0
+
+    def load(self):
+        self.generation, data = load_versioned(self.pickle_path, {})
+        return data
+
+    def signature(self):
+        return file_signature(self.pickle_path)
+
+    def refresh(self, committed, changes):
+        generation, data = load_versioned(self.pickle_path, {}, False)
+        if generation == self.generation:
+            return {}
+        self.generation, current = load_versioned(self.pickle_path, {})
+        return merge_changes(committed, changes_between(committed, current),
+                             changes)
+
+    def vote(self, committed, changes):
+        self.lock.acquire()
+        external = self.refresh(committed, changes)
+        self.stage(committed, changes)
+        return external
+
+    def stage(self, committed, changes):
+        data = committed.copy()
+        apply_changes(data, changes)
+        if self.serializer is None:
+            self.staged = dump_staged([self.generation + 1, data],
+                                      self.pickle_path + '.', '.tmp')
+        else:
+            self.staged = dump_staged([self.generation + 1,
+                                       self.serializer.name],
+                                      self.pickle_path + '.', '.tmp',
+                                      self.serializer.dumps(data))
+        self.written = os.path.getsize(self.staged)
+
+    def finish(self, committed, changes):
+        replace(self.staged, self.pickle_path)
+        self.staged = None
+        self.generation += 1
+        self.lock.release()
+        apply_changes(committed, changes)
 
+    def abort(self):
+        if self.staged is not None:
+            remove_files([self.staged])
+        self.staged = None
+        self.lock.release()
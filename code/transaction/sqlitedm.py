@@ -1,48 +1,483 @@
-import time
+import itertools
+import pickle
+import sqlite3
+import threading
 import transaction
+import uuid
+import weakref
 
 class SQLiteDataManager(object):
+    """Take part in transactions with a SQLite connection.
+
+    The SQLite transaction only begins with the first statement executed
+    through the execute method that is not a query, so a transaction that
+    only reads doesn't take any locks it doesn't need, and has nothing to
+    commit. Getting the connection attribute begins the transaction too,
+    so statements executed on it directly are rolled back with the rest
+    when the transaction aborts. With a coordinator, only execute and
+    queue can write, and the connection attribute raises. ``begin`` can
+    be 'deferred', 'immediate' or 'exclusive', and sets when SQLite takes
+    its locks: with 'immediate', writers wait for each other when they
+    begin instead of failing when they commit.
+
+    A ``read_only`` data manager never begins a transaction and refuses to
+    execute anything but queries. Its connection is switched to query only
+    mode while the data manager has it, so writing to it directly fails.
+
+    Without a coordinator, SQLite can't be prepared, so the data manager
+    commits while voting and sorts after the other data managers. If the
+    commit fails, say because the database is locked, the transaction can
+    still abort everything else, and once the vote of the other data managers
+    has passed, only a failed finish can leave them apart. With more than one
+    uncoordinated data manager, a later one can still fail after an earlier
+    one committed, which is what the coordinator is for.
+    """
 
     transaction_manager = transaction.manager
 
-    def __init__(self, connection):
-        self.connection = connection
-        self.connection.execute("begin")
+    def __init__(self, connection=None, coordinator=None, pool=None,
+                 begin='deferred', read_only=False):
+        if begin not in ('deferred', 'immediate', 'exclusive'):
+            raise ValueError("Unknown begin mode %r" % begin)
+        if connection is None and pool is None:
+            raise ValueError("Either a connection or a pool is needed")
+        self._connection = connection
+        self.query_only = False
+        self.coordinator = coordinator
+        self.pool = pool
+        self.begin_mode = begin
+        self.read_only = read_only
+        self.in_transaction = False
+        self.statements = []
+        self.queued = []
+        self.marks = []
+        self.mark_ids = itertools.count(1)
+        self.writes = 0
+        self.committed = False
+
+    @property
+    def connection(self):
+        """The connection, in the transaction of the data manager.
+
+        Without a transaction, whatever is executed on the connection would
+        be committed right away and stay when the transaction aborts. Since
+        the data manager can't see what is executed on it, getting it counts
+        as a write, so the next savepoint isn't shared with an older one.
+
+        A coordinator can only replay what went through execute and queue,
+        so with a coordinator the connection isn't handed out at all.
+        """
+        if self.coordinator is not None:
+            raise ValueError("Coordinated data manager only writes through "
+                             "execute and queue")
+        if self.read_only:
+            return self.open()
+        connection = self.begin()
+        self.writes += 1
+        return connection
+
+    def open(self):
+        """Return the connection, taking one from the pool if needed."""
+        if self._connection is None:
+            self._connection = self.pool.get()
+        if self.read_only and not self.query_only:
+            self._connection.execute("pragma query_only = on")
+            self.query_only = True
+        return self._connection
+
+    def begin(self):
+        """Begin the SQLite transaction, unless it has begun already."""
+        connection = self.open()
+        if not self.in_transaction:
+            if self.read_only:
+                raise ValueError("Read only data manager cannot write")
+            connection.execute("begin %s" % self.begin_mode)
+            self.in_transaction = True
+            self.changes_before = connection.total_changes
+        return connection
+
+    def release(self):
+        self.statements = []
+        self.queued = []
+        self.marks = []
+        self.writes = 0
+        self.in_transaction = False
+        self.committed = False
+        if self.query_only:
+            self._connection.execute("pragma query_only = off")
+            self.query_only = False
+        if self.pool is not None and self._connection is not None:
+            self.pool.put(self._connection)
+            self._connection = None
+
+    def execute(self, sql, parameters=()):
+        """Execute a statement in the current transaction.
+
+        When the data manager has a coordinator, the statement is also kept,
+        so that the transaction can be replayed if it was decided but the
+        process stopped before this database committed it.
+        """
+        self.flush()
+        if is_query(sql) and not self.in_transaction:
+            return self.open().execute(sql, parameters)
+        connection = self.begin()
+        if not is_query(sql):
+            self.writes += 1
+        if self.coordinator is not None:
+            self.statements.append((sql, tuple(parameters)))
+        return connection.execute(sql, parameters)
+
+    def queue(self, sql, parameters=()):
+        """Execute a statement later, together with others like it.
+
+        Queued statements are executed before the next call to execute,
+        before a savepoint and when the transaction commits. Runs of the
+        same statement are executed with a single executemany call, in
+        the order they were queued.
+        """
+        if self.read_only:
+            raise ValueError("Read only data manager cannot write")
+        if self.queued and self.queued[-1][0] == sql:
+            self.queued[-1][1].append(tuple(parameters))
+        else:
+            self.queued.append((sql, [tuple(parameters)]))
+
+    def flush(self):
+        """Execute the queued statements."""
+        if not self.queued:
+            return
+        connection = self.begin()
+        self.writes += 1
+        queued, self.queued = self.queued, []
+        for sql, rows in queued:
+            if self.coordinator is not None:
+                self.statements.extend([(sql, row) for row in rows])
+            connection.executemany(sql, rows)
 
     def abort(self, transaction):
-        self.connection.rollback()
-        self.connection.execute("begin")
+        self.queued = []
+        if self.in_transaction and not self.committed:
+            self._connection.rollback()
+        self.release()
 
     def tpc_begin(self, transaction):
         pass
 
     def commit(self, transaction):
-        self.connection.commit()
-        self.connection.execute("begin")
+        self.flush()
 
     def tpc_vote(self, transaction):
-        pass
+        if not self.in_transaction:
+            return
+        if self.coordinator is not None:
+            self.coordinator.prepare(self, transaction)
+        else:
+            self._connection.commit()
+            self.committed = True
 
     def tpc_finish(self, transaction):
-        pass
+        if self.coordinator is None or not self.in_transaction:
+            self.release()
+            return
+        self.coordinator.decide(transaction)
+        self._connection.commit()
+        self.release()
+        self.coordinator.finished(self, transaction)
 
     def tpc_abort(self, transaction):
-        pass
+        if self.coordinator is not None:
+            self.coordinator.forget(transaction)
+        self.abort(transaction)
+
+    @property
+    def commits_in_vote(self):
+        return self.coordinator is None
 
     def sortKey(self):
+        if self.coordinator is None:
+            # commits in tpc_vote, so it has to vote last
+            return '~sqlite' + str(id(self))
         return 'sqlite' + str(id(self))
 
     def savepoint(self):
         return SQLiteSavepoint(self)
 
+    def transaction_size(self):
+        """Return the number of rows changed by the transaction that is
+        being committed. SQLite doesn't tell how many bytes it writes."""
+        if not self.in_transaction:
+            return 0, None
+        return self._connection.total_changes - self.changes_before, None
+
+    def mark(self):
+        """Return a SQLite savepoint for the current state.
+
+        The most recent SQLite savepoints whose SQLiteSavepoint objects are
+        all gone are released first, since nobody can roll back to them
+        anymore. SQLite releases every savepoint taken after the one being
+        released, so one that is gone but has a newer one still in use
+        stays on the stack until the newer one goes too. If nothing was
+        written since the last SQLite savepoint, through execute, queue or
+        the connection attribute, it is shared instead of taking a new one.
+        """
+        marks = self.marks
+        while marks and not marks[-1].savepoints:
+            self._connection.execute("release %s" % marks.pop().name)
+        if marks and marks[-1].writes == self.writes:
+            return marks[-1]
+        mark = SavepointMark('sp_%d' % next(self.mark_ids), len(marks),
+                             self.writes)
+        self.begin().execute("savepoint %s" % mark.name)
+        marks.append(mark)
+        return mark
+
+    def rollback_to(self, mark):
+        self.queued = []
+        self._connection.execute("rollback to %s" % mark.name)
+        # rolling back also drops the savepoints SQLite took after it
+        del self.marks[mark.depth + 1:]
+        # back to the state of the mark, as if nothing was written since
+        mark.writes = self.writes
+
 
 class SQLiteSavepoint(object):
 
     def __init__(self, dm):
-        self.dm = dm 
-        self.savepoint_id = 'sp_%s' % str(time.time()).replace('.','')
-        self.dm.connection.execute("savepoint %s" % self.savepoint_id)
+        self.dm = dm
+        if dm.read_only:
+            return
+        dm.flush()
+        self.statements = len(dm.statements)
+        self.mark = dm.mark()
+        self.mark.savepoints.add(self)
 
     def rollback(self):
-        self.dm.connection.execute("rollback to %s" % self.savepoint_id)
+        if self.dm.read_only:
+            return
+        self.dm.rollback_to(self.mark)
+        del self.dm.statements[self.statements:]
+
+
+class SavepointMark(object):
+    """A savepoint on the SQLite connection, and the SQLiteSavepoint
+    objects that can roll back to it."""
+
+    def __init__(self, name, depth, writes):
+        self.name = name
+        self.depth = depth
+        self.writes = writes
+        self.savepoints = weakref.WeakSet()
+
+
+class SQLitePool(object):
+    """Keep open connections to a database for reuse.
+
+    SQLite connections can only be used by the thread that opened them, so
+    each thread keeps its own idle connections, up to ``size`` of them. New
+    connections are set up with the given journal mode and synchronous
+    setting, so a data manager that takes one from the pool can use it
+    right away:
+
+        pool = SQLitePool('Data.db')
+        dm = SQLiteDataManager(pool=pool)
+
+    The data manager takes a connection when it first needs one and gives
+    it back when the transaction finishes or aborts.
+    """
+
+    def __init__(self, path, size=4, journal_mode='wal', synchronous='normal',
+                 timeout=5.0):
+        self.path = path
+        self.size = size
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def idle(self):
+        idle = getattr(self.local, 'idle', None)
+        if idle is None:
+            idle = self.local.idle = []
+        return idle
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                     isolation_level=None)
+        connection.execute("pragma journal_mode = %s" % self.journal_mode)
+        connection.execute("pragma synchronous = %s" % self.synchronous)
+        return connection
+
+    def get(self):
+        idle = self.idle()
+        if idle:
+            return idle.pop()
+        return self.connect()
+
+    def put(self, connection):
+        idle = self.idle()
+        if len(idle) < self.size:
+            idle.append(connection)
+        else:
+            connection.close()
+
+    def close(self):
+        """Close the idle connections of the current thread."""
+        idle = self.idle()
+        while idle:
+            idle.pop().close()
+
+
+def is_query(sql):
+    words = sql.split(None, 1)
+    return bool(words) and words[0].lower() in ('select', 'explain')
+
+
+def database_path(connection):
+    for number, name, path in connection.execute("pragma database_list"):
+        if name == 'main':
+            return path
+
+
+class SQLiteCoordinator(object):
+    """Commit the transactions of several SQLite databases atomically.
+
+    SQLite can't keep a transaction prepared, so the coordinator keeps a
+    journal of the statements that each of its data managers executed
+    instead. While voting, every database records the id of the
+    transaction in a tpc_applied table, as part of the transaction itself.
+    The first data manager to finish writes the statements of all of them
+    to the journal in one commit, which is the point where the transaction
+    is decided. The databases then commit one by one.
+
+    If the process stops before all of them have committed, the journal
+    still has the statements, and the next coordinator opened on it replays
+    them on the databases that don't have the transaction id yet. Journal
+    entries of finished transactions are removed with the next decision,
+    so every transaction costs a single commit of the journal.
+
+    Only the statements executed through SQLiteDataManager.execute and
+    queue can be replayed, which is why a coordinated data manager doesn't
+    hand out its connection.
+    """
+
+    def __init__(self, journal_path):
+        self.connection = sqlite3.connect(journal_path, isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.execute("create table if not exists tpc_journal "
+                                "(txid text, path text, statements blob, "
+                                "primary key (txid, path))")
+        self.lock = threading.Lock()
+        self.prepared = {}
+        self.decided = {}
+        self.finished_txids = []
+        self.forgotten = {}
+        self.recover()
+
+    def prepare(self, dm, transaction):
+        path = database_path(dm.open())
+        self.lock.acquire()
+        try:
+            txid, participants = self.prepared.setdefault(
+                transaction, (uuid.uuid4().hex, {}))
+            forgotten = self.forgotten.pop(path, [])
+        finally:
+            self.lock.release()
+        connection = dm.open()
+        connection.execute("create table if not exists tpc_applied "
+                           "(txid text primary key)")
+        connection.executemany("delete from tpc_applied where txid = ?",
+                               [(old,) for old in forgotten])
+        connection.execute("insert into tpc_applied values (?)", (txid,))
+        participants[dm] = (path, list(dm.statements))
+
+    def decide(self, transaction):
+        self.lock.acquire()
+        try:
+            if transaction not in self.prepared:
+                return
+            txid, participants = self.prepared.pop(transaction)
+            finished, self.finished_txids = self.finished_txids, []
+            connection = self.connection
+            connection.execute("begin")
+            try:
+                connection.executemany(
+                    "delete from tpc_journal where txid = ?",
+                    [(old,) for old, paths in finished])
+                connection.executemany(
+                    "insert into tpc_journal values (?, ?, ?)",
+                    [(txid, path, sqlite3.Binary(pickle.dumps(statements)))
+                     for path, statements in participants.values()])
+                connection.commit()
+            except:
+                connection.rollback()
+                self.finished_txids = finished + self.finished_txids
+                raise
+            for old, paths in finished:
+                for path in paths:
+                    self.forgotten.setdefault(path, []).append(old)
+            paths = [path for path, statements in participants.values()]
+            self.decided[transaction] = (txid, set(participants), paths)
+        finally:
+            self.lock.release()
+
+    def finished(self, dm, transaction):
+        self.lock.acquire()
+        try:
+            txid, waiting, paths = self.decided[transaction]
+            waiting.discard(dm)
+            if not waiting:
+                # the journal entry goes away with the next decision
+                del self.decided[transaction]
+                self.finished_txids.append((txid, paths))
+        finally:
+            self.lock.release()
+
+    def forget(self, transaction):
+        self.lock.acquire()
+        try:
+            self.prepared.pop(transaction, None)
+        finally:
+            self.lock.release()
+
+    def recover(self):
+        """Replay the decided transactions that some databases missed."""
+        rows = self.connection.execute(
+            "select txid, path, statements from tpc_journal").fetchall()
+        recovered = {}
+        for txid, path, statements in rows:
+            connection = sqlite3.connect(path, isolation_level=None)
+            try:
+                connection.execute("begin immediate")
+                connection.execute("create table if not exists tpc_applied "
+                                   "(txid text primary key)")
+                applied = connection.execute(
+                    "select 1 from tpc_applied where txid = ?",
+                    (txid,)).fetchone()
+                if applied is None:
+                    for sql, parameters in pickle.loads(str(statements)):
+                        connection.execute(sql, parameters)
+                    connection.execute("insert into tpc_applied values (?)",
+                                       (txid,))
+                connection.commit()
+            finally:
+                connection.close()
+            recovered.setdefault(path, []).append(txid)
+        self.connection.execute("delete from tpc_journal")
+        self.forgotten = recovered
+
+
+def connect_attached(path, **databases):
+    """Open a connection to a database with others attached to it by name.
 
+    A single SQLiteDataManager for the connection commits the changes to
+    all of them at once. Unless the main database uses WAL, SQLite writes
+    a master journal and syncs all the databases in the same commit, and
+    deleting the master journal is what makes the commit atomic. A single
+    coordinated commit is cheaper than one for each database through a
+    SQLiteCoordinator, but all the statements have to go through the same
+    connection and name their tables, as in ``d2.test``.
+    """
+    connection = sqlite3.connect(path, isolation_level=None)
+    for name, attached in databases.items():
+        connection.execute("attach database ? as %s" % name, (attached,))
+    return connection
@@ -0,0 +1,145 @@
+import math
+import threading
+import time
+
+
+class TransactionStats(object):
+    """Keep timings and sizes of the last ``size`` transactions.
+
+    Each transaction adds a record with the time each of its phases took,
+    how many keys it changed, how many bytes were written, and whether it
+    committed. Records go in a fixed size ring, so keeping them costs the
+    same however long the process runs, and summary returns percentiles
+    over the ones in the ring.
+    """
+
+    phases = ('tpc_begin', 'commit', 'tpc_vote', 'tpc_finish', 'abort',
+              'tpc_abort')
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.records = []
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, timings, keys, written, committed):
+        record = (timings, keys, written, committed)
+        self.lock.acquire()
+        try:
+            if len(self.records) < self.size:
+                self.records.append(record)
+            else:
+                self.records[self.count % self.size] = record
+            self.count += 1
+        finally:
+            self.lock.release()
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """Return the percentiles of each phase, of the total time, and of
+        the keys changed and bytes written by committed transactions."""
+        self.lock.acquire()
+        try:
+            records = list(self.records)
+            count = self.count
+        finally:
+            self.lock.release()
+        values = dict([(phase, []) for phase in self.phases])
+        values['total'] = []
+        values['keys'] = []
+        values['bytes'] = []
+        committed = 0
+        for timings, keys, written, done in records:
+            for phase, seconds in timings.items():
+                values[phase].append(seconds)
+            values['total'].append(sum(timings.values()))
+            if done:
+                committed += 1
+                values['keys'].append(keys)
+                if written is not None:
+                    values['bytes'].append(written)
+        summary = {'transactions': count, 'recorded': len(records),
+                   'committed': committed}
+        for name, numbers in values.items():
+            if numbers:
+                numbers.sort()
+                summary[name] = dict(
+                    [('p%d' % p, percentile(numbers, p))
+                     for p in percentiles] + [('max', numbers[-1])])
+        return summary
+
+
+def percentile(numbers, p):
+    """Return the p-th percentile of a sorted list, by nearest rank."""
+    return numbers[max(0, int(math.ceil(len(numbers) * p / 100.0)) - 1)]
+
+
+class InstrumentedDataManager(object):
+    """Time the transaction phases of another data manager.
+
+    Join it to the transaction instead of the data manager itself. When
+    the transaction commits or aborts, a record is added to ``stats``,
+    a TransactionStats. If the data manager has a transaction_size method,
+    the keys changed and bytes written are recorded too.
+    """
+
+    def __init__(self, dm, stats):
+        self.dm = dm
+        self.stats = stats
+        self.timings = {}
+        self.size = (0, None)
+        self.recorded = None
+
+    def timed(self, phase, transaction):
+        start = time.time()
+        try:
+            getattr(self.dm, phase)(transaction)
+        finally:
+            self.timings[phase] = (self.timings.get(phase, 0) +
+                                   time.time() - start)
+
+    def record(self, transaction, committed):
+        # aborting a transaction that failed to commit calls us again
+        if transaction is not self.recorded:
+            keys, written = self.size
+            self.stats.add(self.timings, keys, written, committed)
+            self.recorded = transaction
+        self.timings = {}
+        self.size = (0, None)
+
+    def abort(self, transaction):
+        try:
+            self.timed('abort', transaction)
+        finally:
+            # a failed commit calls tpc_abort afterwards
+            if 'tpc_begin' not in self.timings:
+                self.record(transaction, False)
+
+    def tpc_begin(self, transaction):
+        self.timed('tpc_begin', transaction)
+
+    def commit(self, transaction):
+        self.timed('commit', transaction)
+
+    def tpc_vote(self, transaction):
+        self.timed('tpc_vote', transaction)
+        transaction_size = getattr(self.dm, 'transaction_size', None)
+        if transaction_size is not None:
+            self.size = transaction_size()
+
+    def tpc_finish(self, transaction):
+        try:
+            self.timed('tpc_finish', transaction)
+        finally:
+            self.record(transaction, True)
+
+    def tpc_abort(self, transaction):
+        try:
+            self.timed('tpc_abort', transaction)
+        finally:
+            self.record(transaction, False)
+
+    def sortKey(self):
+        return self.dm.sortKey()
+
+    def savepoint(self):
+        return self.dm.savepoint()
@@ -1,4 +1,4 @@
-from sqlitedm import SQLiteDataManager
+from sqlitedm import SQLiteCoordinator, SQLiteDataManager
 import transaction
 import sqlite3
 
@@ -8,19 +8,20 @@ c3 = sqlite3.connect("./d3.db", isolation_level=None)
 c1.execute("delete from test")
 c2.execute("delete from test")
 c3.execute("delete from test")
-d1 = SQLiteDataManager(c1)
-d2 = SQLiteDataManager(c2)
-d3 = SQLiteDataManager(c3)
+coordinator = SQLiteCoordinator("./coordinator.db")
+d1 = SQLiteDataManager(c1, coordinator)
+d2 = SQLiteDataManager(c2, coordinator)
+d3 = SQLiteDataManager(c3, coordinator)
 t = transaction.get()
 t.join(d1)
 t.join(d2)
 t.join(d3)
-c1.execute("insert into test values(1,'a')")
-c2.execute("insert into test values(2,'b')")
-c3.execute("insert into test values(3,'c')")
-c1.execute("insert into test values(4,'d')")
-c2.execute("insert into test values(5,'e')")
-c3.execute("insert into test values(6,'f')")
+d1.execute("insert into test values(1,'a')")
+d2.execute("insert into test values(2,'b')")
+d3.execute("insert into test values(3,'c')")
+d1.execute("insert into test values(4,'d')")
+d2.execute("insert into test values(5,'e')")
+d3.execute("insert into test values(6,'f')")
 t.commit()
 for c in (c1,c2,c3):
     r = c.execute("select * from test")
@@ -34,12 +35,12 @@ t.join(d3)
 #c1.execute("begin")
 #c2.execute("begin")
 #c3.execute("begin")
-c1.execute("insert into test values(10,'a')")
-c2.execute("insert into test values(20,'b')")
-c3.execute("insert into test values(30,'c')")
-c1.execute("insert into test values(40,'d')")
-c2.execute("insert into test values(50,'e')")
-c3.execute("insert into test values(60,'f')")
+d1.execute("insert into test values(10,'a')")
+d2.execute("insert into test values(20,'b')")
+d3.execute("insert into test values(30,'c')")
+d1.execute("insert into test values(40,'d')")
+d2.execute("insert into test values(50,'e')")
+d3.execute("insert into test values(60,'f')")
 for c in (c1,c2,c3):
     r = c.execute("select * from test")
     for s in r.fetchall():
@@ -55,13 +56,13 @@ t = transaction.get()
 t.join(d1)
 t.join(d2)
 t.join(d3)
-c1.execute("insert into test values(10,'a')")
-c2.execute("insert into test values(20,'b')")
-c3.execute("insert into test values(30,'c')")
+d1.execute("insert into test values(10,'a')")
+d2.execute("insert into test values(20,'b')")
+d3.execute("insert into test values(30,'c')")
 sp = t.savepoint()
-c1.execute("insert into test values(40,'d')")
-c2.execute("insert into test values(50,'e')")
-c3.execute("insert into test values(60,'f')")
+d1.execute("insert into test values(40,'d')")
+d2.execute("insert into test values(50,'e')")
+d3.execute("insert into test values(60,'f')")
 for c in (c1,c2,c3):
     r = c.execute("select * from test")
     for s in r.fetchall():
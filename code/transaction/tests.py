@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import threading
+import transaction
+import unittest
+
+from pickledm import ConflictError
+from pickledm import PickleDataManager
+from pickledm import PickleStorage
+from storages import GroupCommitStorage
+from storages import SharedStorage
+
+class SharedStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'Data.pkl')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def increment(self, storage, threads=8, increments=25):
+        """Increment a counter from several threads, retrying conflicts."""
+        def work():
+            manager = transaction.TransactionManager()
+            for i in range(increments):
+                while True:
+                    dm = PickleDataManager(storage=storage(self.path))
+                    manager.begin().join(dm)
+                    if 'count' in dm:
+                        dm['count'] = dm['count'] + 1
+                    else:
+                        dm['count'] = 1
+                    try:
+                        manager.commit()
+                        break
+                    except ConflictError:
+                        manager.abort()
+        workers = [threading.Thread(target=work) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        dm = PickleDataManager(storage=PickleStorage(self.path))
+        self.assertEqual(dm['count'], threads * increments)
+
+    def test_shared_increments(self):
+        self.increment(lambda path: SharedStorage(PickleStorage(path)))
+
+    def test_group_commit_increments(self):
+        self.increment(lambda path: GroupCommitStorage(PickleStorage(path),
+                                                       window=0.001, size=4))
+
+    def test_group_commit_conflicts_within_batch(self):
+        first = transaction.TransactionManager()
+        second = transaction.TransactionManager()
+        dms = []
+        for manager in (first, second):
+            dm = PickleDataManager(storage=GroupCommitStorage(
+                PickleStorage(self.path), window=1, size=2))
+            manager.begin().join(dm)
+            dm['count'] = len(dms)
+            dms.append(dm)
+        errors = []
+        def commit(manager):
+            try:
+                manager.commit()
+            except ConflictError:
+                errors.append(manager)
+                manager.abort()
+        workers = [threading.Thread(target=commit, args=(manager,))
+                   for manager in (first, second)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(len(errors), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
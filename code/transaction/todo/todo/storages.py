@@ -0,0 +1,1197 @@
+import bisect
+import mmap
+import os
+import pickle
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from pickledm import ConflictError
+from pickledm import FileLock
+from pickledm import PickleStorage
+from pickledm import _DELETED
+from pickledm import _MISSING
+from pickledm import apply_changes
+from pickledm import changes_between
+from pickledm import dump_staged
+from pickledm import file_signature
+from pickledm import load_versioned
+from pickledm import merge_changes
+from pickledm import remove_files
+from pickledm import replace
+
+
+class JournalStorage(PickleStorage):
+    """Append the changes of each transaction to a log file.
+
+    The log lives next to the snapshot, in ``pickle_path + '.log'``. Each
+    record holds the generation and the keys that were set and deleted by
+    one transaction, so a commit only writes what changed. Loading reads
+    the snapshot and replays the log on top of it. After
+    ``compact_every`` records the next commit writes a fresh snapshot
+    instead and empties the log.
+
+    When other processes append to the log, a commit only has to read
+    their records to catch up, and conflicts are found by comparing keys.
+    A serializer only applies to the snapshot; the records are small and
+    are always pickled.
+    """
+
+    header = struct.Struct('>I')
+
+    def __init__(self, pickle_path='Data.pkl', compact_every=100,
+                 serializer=None):
+        PickleStorage.__init__(self, pickle_path, serializer)
+        self.log_path = pickle_path + '.log'
+        self.compact_every = compact_every
+        self.snapshot_generation = 0
+        self.log_end = 0
+        self.records = 0
+        self.record = None
+
+    def load(self):
+        data = PickleStorage.load(self)
+        self.snapshot_generation = self.generation
+        self.log_end = 0
+        self.records = 0
+        apply_changes(data, self.replay())
+        return data
+
+    def replay(self):
+        """Read the log records after the ones we have seen.
+
+        Return the changes they make. A commit that crashed half way
+        leaves a torn record at the end, which is ignored.
+        """
+        changes = {}
+        try:
+            log_file = open(self.log_path, 'rb')
+        except IOError:
+            return changes
+        try:
+            log_file.seek(self.log_end)
+            while True:
+                header = log_file.read(self.header.size)
+                if len(header) < self.header.size:
+                    break
+                size, = self.header.unpack(header)
+                record = log_file.read(size)
+                if len(record) < size:
+                    break
+                generation, changed, deleted = pickle.loads(record)
+                self.log_end = log_file.tell()
+                self.records += 1
+                if generation <= self.snapshot_generation:
+                    # the snapshot already has it, from a compaction that
+                    # stopped before the log was emptied
+                    continue
+                self.generation = generation
+                changes.update(changed)
+                for name in deleted:
+                    changes[name] = _DELETED
+        finally:
+            log_file.close()
+        return changes
+
+    def refresh(self, committed, changes):
+        generation, data = load_versioned(self.pickle_path, {}, False)
+        if generation != self.snapshot_generation:
+            # the log was compacted, so compare with the whole data
+            current = self.load()
+            external = changes_between(committed, current)
+        else:
+            external = self.replay()
+            # we hold the lock, so anything after the last record is torn
+            try:
+                log_file = open(self.log_path, 'r+b')
+            except IOError:
+                pass
+            else:
+                try:
+                    log_file.truncate(self.log_end)
+                finally:
+                    log_file.close()
+        return merge_changes(committed, external, changes)
+
+    def vote(self, committed, changes):
+        self.lock.acquire()
+        external = self.refresh(committed, changes)
+        if self.records + 1 >= self.compact_every:
+            self.stage(committed, changes)
+            return external
+        changed = {}
+        deleted = []
+        for name, value in changes.items():
+            if value is _DELETED:
+                deleted.append(name)
+            else:
+                changed[name] = value
+        try:
+            record = pickle.dumps((self.generation + 1, changed, deleted))
+        except (TypeError, pickle.PicklingError):
+            raise ValueError("Unpickleable value cannot be saved")
+        self.record = self.header.pack(len(record)) + record
+        self.written = len(self.record)
+        return external
+
+    def signature(self):
+        return (file_signature(self.pickle_path),
+                file_signature(self.log_path))
+
+    def finish(self, committed, changes):
+        if self.staged is not None:
+            # the new snapshot goes in place before the log is emptied, so
+            # stopping in between only leaves records that replay skips
+            replace(self.staged, self.pickle_path)
+            self.staged = None
+            open(self.log_path, 'wb').close()
+            self.snapshot_generation = self.generation + 1
+            self.log_end = 0
+            self.records = 0
+        else:
+            log_file = open(self.log_path, 'ab')
+            try:
+                log_file.write(self.record)
+                log_file.flush()
+                os.fsync(log_file.fileno())
+            finally:
+                log_file.close()
+            self.log_end += len(self.record)
+            self.record = None
+            self.records += 1
+        self.generation += 1
+        self.lock.release()
+        apply_changes(committed, changes)
+
+    def abort(self):
+        PickleStorage.abort(self)
+        self.record = None
+
+
+class ShardedStorage(object):
+    """Spread the dictionary over several pickle files.
+
+    Keys are hashed into ``shards`` segment files, which are listed in a
+    small index pickle at ``pickle_path + '.index'``. Loading only reads
+    the index. A segment is read the first time one of its keys is needed,
+    and a commit only writes the segments that hold changed keys. Segments
+    are never overwritten: each commit writes new segment files and then
+    replaces the index, which switches to all of them at once.
+
+    The index has a generation number, like the file of a PickleStorage.
+    When another process committed first, only the loaded segments that
+    it replaced are compared, to merge its changes or find conflicts.
+
+    The number of shards is fixed when the index is first written.
+    """
+
+    def __init__(self, pickle_path='Data.pkl', shards=16):
+        self.pickle_path = pickle_path
+        self.index_path = pickle_path + '.index'
+        self.directory = os.path.dirname(os.path.abspath(pickle_path))
+        self.lock = FileLock(pickle_path + '.lock')
+        self.generation = 0
+        self.files = [None] * shards
+        self.staged = None
+        self.written = 0
+        self.staged_files = None
+
+    @property
+    def shards(self):
+        return len(self.files)
+
+    def shard_of(self, name):
+        if isinstance(name, unicode):
+            # u'k' == 'k', so both have to land in the same shard
+            name = name.encode('utf-8')
+        return zlib.crc32(repr(name)) % self.shards
+
+    def load_shard(self, shard):
+        while self.files[shard] is not None:
+            try:
+                data_file = open(os.path.join(self.directory,
+                                              self.files[shard]), 'rb')
+            except IOError:
+                # another process replaced it after we read the index
+                generation, files = load_versioned(self.index_path, None)
+                if files is None or files[shard] == self.files[shard]:
+                    raise
+                self.files[shard] = files[shard]
+                continue
+            try:
+                return pickle.load(data_file)
+            finally:
+                data_file.close()
+        return {}
+
+    def load(self):
+        generation, files = load_versioned(self.index_path, None)
+        if files is not None:
+            self.generation, self.files = generation, files
+        return ShardedData(self)
+
+    def refresh(self, committed, changes):
+        generation, files = load_versioned(self.index_path, None)
+        if files is None or generation == self.generation:
+            return {}
+        changed_shards = set([self.shard_of(name) for name in changes])
+        external = {}
+        unknown = []
+        for shard, name in enumerate(files):
+            if name == self.files[shard]:
+                continue
+            self.files[shard] = name
+            if shard in committed.loaded:
+                external.update(changes_between(committed.loaded[shard],
+                                                self.load_shard(shard)))
+            elif shard in changed_shards:
+                unknown.append(shard)
+        self.generation = generation
+        external = merge_changes(committed, external, changes)
+        if unknown:
+            # we can't tell what changed in shards we never loaded
+            raise ConflictError("Conflicting changes to shards %s" %
+                                ', '.join(map(str, unknown)), external)
+        return external
+
+    def vote(self, committed, changes):
+        self.lock.acquire()
+        external = self.refresh(committed, changes)
+        by_shard = {}
+        for name, value in changes.items():
+            by_shard.setdefault(self.shard_of(name), {})[name] = value
+        files = list(self.files)
+        self.staged = []
+        try:
+            for shard, shard_changes in by_shard.items():
+                data = committed.shard(shard).copy()
+                apply_changes(data, shard_changes)
+                path = dump_staged([data], '%s.%d.' % (self.pickle_path,
+                                                       shard))
+                self.staged.append(path)
+                files[shard] = os.path.basename(path)
+            self.staged.append(dump_staged([self.generation + 1, files],
+                                           self.index_path + '.', '.tmp'))
+        except:
+            self.abort()
+            raise
+        self.staged_files = files
+        self.written = sum([os.path.getsize(staged) for staged in self.staged])
+        return external
+
+    def signature(self):
+        return file_signature(self.index_path)
+
+    def finish(self, committed, changes):
+        replace(self.staged[-1], self.index_path)
+        old = [os.path.join(self.directory, old)
+               for old, new in zip(self.files, self.staged_files)
+               if old is not None and old != new]
+        self.files = self.staged_files
+        self.staged = self.staged_files = None
+        self.generation += 1
+        self.lock.release()
+        remove_files(old)
+        apply_changes(committed, changes)
+
+    def abort(self):
+        if self.staged is not None:
+            remove_files(self.staged)
+        self.staged = self.staged_files = None
+        self.lock.release()
+
+
+class ShardedData(object):
+    """The committed data of a ShardedStorage, loaded one shard at a time."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.loaded = {}
+
+    def shard(self, shard):
+        data = self.loaded.get(shard)
+        if data is None:
+            data = self.loaded[shard] = self.storage.load_shard(shard)
+        return data
+
+    def shard_for(self, name):
+        return self.shard(self.storage.shard_of(name))
+
+    def __getitem__(self, name):
+        return self.shard_for(name)[name]
+
+    def __setitem__(self, name, value):
+        self.shard_for(name)[name] = value
+
+    def __contains__(self, name):
+        return name in self.shard_for(name)
+
+    def pop(self, name, *default):
+        return self.shard_for(name).pop(name, *default)
+
+    def keys(self):
+        keys = []
+        for shard in range(self.storage.shards):
+            keys.extend(self.shard(shard).keys())
+        return keys
+
+    def items(self):
+        items = []
+        for shard in range(self.storage.shards):
+            items.extend(self.shard(shard).items())
+        return items
+
+
+class RecordStorage(object):
+    """Keep every value in its own pickle, in a single memory mapped file.
+
+    The file starts with a header pointing to an index that maps each key
+    to the offset and size of the pickle of its value. Loading only reads
+    the index, and a value is unpickled the first time it is looked up, so
+    listing the keys never touches the values.
+
+    A commit appends the pickles of the changed values and a new index to
+    the end of the file while voting, and then points the header to the
+    new index. Once the file is more than ``compact_ratio`` times the size
+    of the live values, the next commit copies the live pickles to a fresh
+    file instead.
+
+    The header also holds a generation number. When another process
+    committed first, the keys whose index entries changed are the keys it
+    changed, so merging its changes or finding conflicts only needs the
+    new index.
+    """
+
+    header = struct.Struct('>8sQQQ')
+    magic = 'PDMREC02'
+
+    def __init__(self, pickle_path='Data.rec', compact_ratio=2):
+        self.pickle_path = pickle_path
+        self.compact_ratio = compact_ratio
+        self.lock = FileLock(pickle_path + '.lock')
+        self.generation = 0
+        self.inode = None
+        self.staged = None
+        self.written = 0
+
+    def signature(self):
+        return file_signature(self.pickle_path)
+
+    def open(self):
+        """Map the file and return its generation, buffer and index."""
+        try:
+            data_file = open(self.pickle_path, 'rb')
+        except IOError:
+            return 0, None, {}
+        try:
+            header = data_file.read(self.header.size)
+            if len(header) < self.header.size:
+                return 0, None, {}
+            magic, generation, offset, size = self.header.unpack(header)
+            if magic != self.magic:
+                raise ValueError("%s is not a record file" % self.pickle_path)
+            buffer = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.inode = os.fstat(data_file.fileno()).st_ino
+        finally:
+            data_file.close()
+        if not size:
+            return generation, buffer, {}
+        return generation, buffer, pickle.loads(buffer[offset:offset + size])
+
+    def load(self):
+        self.generation, buffer, index = self.open()
+        return RecordData(buffer, index)
+
+    def refresh(self, committed, changes):
+        try:
+            data_file = open(self.pickle_path, 'rb')
+        except IOError:
+            return {}
+        try:
+            header = data_file.read(self.header.size)
+        finally:
+            data_file.close()
+        if len(header) < self.header.size:
+            return {}
+        if self.header.unpack(header)[1] == self.generation:
+            return {}
+        inode = self.inode
+        self.generation, buffer, index = self.open()
+        current = RecordData(buffer, index)
+        # appending leaves the records of unchanged values where they were,
+        # but compacting to a new file moves them, so compare the values
+        compacted = self.inode != inode
+        external = {}
+        for name, entry in index.items():
+            if name not in committed:
+                external[name] = current[name]
+            elif compacted:
+                if committed[name] != current[name]:
+                    external[name] = current[name]
+            elif committed.index[name] != entry:
+                external[name] = current[name]
+        for name in committed.index:
+            if name not in index:
+                external[name] = _DELETED
+        committed.buffer, committed.index = buffer, index
+        committed.values.update(current.values)
+        return merge_changes(committed, external, changes)
+
+    def vote(self, committed, changes):
+        self.lock.acquire()
+        external = self.refresh(committed, changes)
+        index = committed.index.copy()
+        records = []
+        for name, value in changes.items():
+            if value is _DELETED:
+                index.pop(name, None)
+                continue
+            try:
+                records.append((name, pickle.dumps(value)))
+            except (TypeError, pickle.PicklingError):
+                raise ValueError("Unpickleable value cannot be saved")
+        if committed.buffer is None:
+            self.staged = self.append(None, index, records)
+        else:
+            live = sum([length for offset, length in index.values()])
+            live += sum([len(record) for name, record in records])
+            if len(committed.buffer) > self.compact_ratio * live:
+                self.staged = self.compact(committed.buffer, index, records)
+            else:
+                self.staged = self.append(len(committed.buffer), index,
+                                          records)
+        how, where, index, (offset, size) = self.staged
+        self.written = offset + size
+        if how == 'append':
+            self.written -= where
+        return external
+
+    def append(self, size, index, records):
+        if size is None:
+            data_file = open(self.pickle_path, 'w+b')
+            data_file.write(self.header.pack(self.magic, 0, 0, 0))
+        else:
+            data_file = open(self.pickle_path, 'r+b')
+            data_file.seek(size)
+        try:
+            data_file.truncate()
+            index_at = self.write(data_file, index, records)
+        finally:
+            data_file.close()
+        return 'append', size or self.header.size, index, index_at
+
+    def compact(self, buffer, index, records):
+        directory, name = os.path.split(os.path.abspath(self.pickle_path))
+        fd, path = tempfile.mkstemp(prefix=name + '.', suffix='.tmp',
+                                    dir=directory)
+        data_file = os.fdopen(fd, 'w+b')
+        try:
+            try:
+                data_file.seek(self.header.size)
+                for name, (offset, length) in index.items():
+                    index[name] = (data_file.tell(), length)
+                    data_file.write(buffer[offset:offset + length])
+                index_at = self.write(data_file, index, records)
+                self.write_header(data_file, index_at)
+            finally:
+                data_file.close()
+        except:
+            remove_files([path])
+            raise
+        return 'compact', path, index, index_at
+
+    def write(self, data_file, index, records):
+        for name, record in records:
+            index[name] = (data_file.tell(), len(record))
+            data_file.write(record)
+        offset = data_file.tell()
+        data_file.write(pickle.dumps(index, pickle.HIGHEST_PROTOCOL))
+        data_file.flush()
+        os.fsync(data_file.fileno())
+        return offset, data_file.tell() - offset
+
+    def write_header(self, data_file, index_at):
+        data_file.seek(0)
+        data_file.write(self.header.pack(self.magic, self.generation + 1,
+                                         *index_at))
+        data_file.flush()
+        os.fsync(data_file.fileno())
+
+    def finish(self, committed, changes):
+        how, where, index, index_at = self.staged
+        self.staged = None
+        if how == 'compact':
+            replace(where, self.pickle_path)
+            data_file = open(self.pickle_path, 'rb')
+        else:
+            data_file = open(self.pickle_path, 'r+b')
+        try:
+            if how == 'append':
+                self.write_header(data_file, index_at)
+            committed.buffer = mmap.mmap(data_file.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+            self.inode = os.fstat(data_file.fileno()).st_ino
+        finally:
+            data_file.close()
+        committed.index = index
+        self.generation += 1
+        self.lock.release()
+        apply_changes(committed, changes)
+
+    def abort(self):
+        if self.staged is not None:
+            how, where, index, index_at = self.staged
+            self.staged = None
+            if how == 'compact':
+                remove_files([where])
+            else:
+                # drop the appended records, the header doesn't point to them
+                data_file = open(self.pickle_path, 'r+b')
+                try:
+                    data_file.truncate(where)
+                finally:
+                    data_file.close()
+        self.lock.release()
+
+
+class RecordData(object):
+    """The committed data of a RecordStorage, unpickled on demand."""
+
+    def __init__(self, buffer, index):
+        self.buffer = buffer
+        self.index = index
+        self.values = {}
+
+    def __getitem__(self, name):
+        value = self.values.get(name, _MISSING)
+        if value is _MISSING:
+            offset, length = self.index[name]
+            value = pickle.loads(self.buffer[offset:offset + length])
+            self.values[name] = value
+        return value
+
+    def __setitem__(self, name, value):
+        self.values[name] = value
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def pop(self, name, *default):
+        # only used to apply deletions, so don't bother unpickling the value
+        self.values.pop(name, None)
+        self.index.pop(name, *default)
+
+    def keys(self):
+        return self.index.keys()
+
+    def items(self):
+        return [(name, self[name]) for name in self.index]
+
+
+class OrderedStorage(object):
+    """Keep the keys of another storage sorted.
+
+    The sorted keys are built when the data is loaded and then updated on
+    every commit, which lets PickleDataManager.items return the items in
+    order, or just a page or a range of them, without sorting all the keys
+    each time. It pays off when the loaded data is kept around, so use it
+    inside a SharedStorage.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.pickle_path = storage.pickle_path
+
+    @property
+    def written(self):
+        return self.storage.written
+
+    def signature(self):
+        return self.storage.signature()
+
+    def load(self):
+        return OrderedData(self.storage.load())
+
+    def vote(self, committed, changes):
+        try:
+            external = self.storage.vote(committed.data, changes)
+        except ConflictError as error:
+            committed.update_keys(error.changes)
+            raise
+        committed.update_keys(external)
+        return external
+
+    def finish(self, committed, changes):
+        self.storage.finish(committed.data, changes)
+        committed.update_keys(changes)
+
+    def abort(self):
+        self.storage.abort()
+
+
+class OrderedData(object):
+    """The committed data of an OrderedStorage."""
+
+    def __init__(self, data):
+        self.data = data
+        self.sorted_keys = SortedKeys(data.keys())
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def __contains__(self, name):
+        return name in self.data
+
+    def keys(self):
+        return self.data.keys()
+
+    def items(self):
+        return self.data.items()
+
+    def update_keys(self, changes):
+        for name, value in changes.items():
+            if value is _DELETED:
+                self.sorted_keys.discard(name)
+            else:
+                self.sorted_keys.add(name)
+
+
+class SortedKeys(object):
+    """A sorted list of keys, split in buckets.
+
+    Adding or removing a key only has to move the keys in its bucket, and
+    a bucket is found with a binary search on the first key of each one,
+    a bit like a two level B-tree.
+    """
+
+    bucket_size = 512
+
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        size = self.bucket_size
+        self.buckets = [keys[i:i + size] for i in range(0, len(keys), size)]
+        self.firsts = [bucket[0] for bucket in self.buckets]
+        self.length = len(keys)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self.iterate()
+
+    def locate(self, key):
+        return bisect.bisect_right(self.firsts, key) - 1
+
+    def add(self, key):
+        i = self.locate(key)
+        if i < 0:
+            if not self.buckets:
+                self.buckets.append([])
+                self.firsts.append(key)
+            i = 0
+        bucket = self.buckets[i]
+        j = bisect.bisect_left(bucket, key)
+        if j < len(bucket) and bucket[j] == key:
+            return
+        bucket.insert(j, key)
+        self.firsts[i] = bucket[0]
+        self.length += 1
+        if len(bucket) > 2 * self.bucket_size:
+            half = len(bucket) // 2
+            self.buckets[i:i + 1] = [bucket[:half], bucket[half:]]
+            self.firsts[i:i + 1] = [bucket[0], bucket[half]]
+
+    def discard(self, key):
+        i = self.locate(key)
+        if i < 0:
+            return
+        bucket = self.buckets[i]
+        j = bisect.bisect_left(bucket, key)
+        if j == len(bucket) or bucket[j] != key:
+            return
+        del bucket[j]
+        self.length -= 1
+        if bucket:
+            self.firsts[i] = bucket[0]
+        else:
+            del self.buckets[i]
+            del self.firsts[i]
+
+    def iterate(self, min=None, max=None, start=0):
+        """Iterate over the keys between min and max, both included,
+        skipping the first start of them."""
+        buckets = self.buckets[:]
+        i = j = 0
+        if min is not None:
+            i = self.locate(min)
+            if i < 0:
+                i = 0
+            elif i < len(buckets):
+                j = bisect.bisect_left(buckets[i], min)
+        while i < len(buckets) and start >= len(buckets[i]) - j:
+            start -= len(buckets[i]) - j
+            i += 1
+            j = 0
+        j += start
+        for bucket in buckets[i:]:
+            for key in bucket[j:]:
+                if max is not None and key > max:
+                    return
+                yield key
+            j = 0
+
+
+class SharedStorage(object):
+    """Share the committed data of a storage among the data managers of a
+    process.
+
+    The first data manager to use a storage loads its data as usual. Data
+    managers created later for the same kind of storage and path reuse the
+    same storage and committed data for as long as the files on disk have
+    not been changed by somebody else, so they don't have to load anything.
+    Each data manager still keeps its own changes until it commits.
+
+    Since the committed data is shared, commits on the same path are done
+    one at a time, from tpc_vote to tpc_finish or tpc_abort, and committed
+    changes are visible to the other data managers right away. The entry
+    counts those commits and remembers which one last changed each key, so
+    a data manager that changes a key that another one committed since its
+    own transaction began gets a ConflictError while voting, instead of
+    overwriting it.
+
+    That state belongs to one data manager, so every data manager needs a
+    SharedStorage of its own; loading one a second time raises a
+    ValueError. The storages underneath are shared anyway:
+
+        dm = PickleDataManager(storage=SharedStorage(PickleStorage(path)))
+    """
+
+    entries = {}
+    entries_lock = threading.Lock()
+
+    def __init__(self, storage):
+        self.key = (storage.__class__, os.path.abspath(storage.pickle_path))
+        self.pickle_path = storage.pickle_path
+        self.storage = storage
+        self.entry = None
+        self.locked = False
+        self.committing = None
+        self.generation = 0
+
+    @property
+    def written(self):
+        return self.storage.written
+
+    def load(self):
+        if self.entry is not None:
+            raise ValueError("A SharedStorage can only be used by one data "
+                             "manager")
+        self.entries_lock.acquire()
+        try:
+            entry = self.entries.get(self.key)
+            if entry is None or not entry.current():
+                entry = SharedEntry(self.storage)
+                self.entries[self.key] = entry
+        finally:
+            self.entries_lock.release()
+        self.entry = entry
+        self.storage = entry.storage
+        self.generation = entry.generation
+        return entry.data
+
+    def enter(self):
+        """Note that the current thread commits through the entry.
+
+        A thread can't commit two data managers of the same entry at once,
+        as it would wait for itself; that raises a ValueError instead.
+        """
+        thread = threading.current_thread()
+        if thread in self.entry.committing:
+            raise ValueError("%s is already being committed by this thread"
+                             % self.pickle_path)
+        self.entry.committing.add(thread)
+        self.committing = thread
+
+    def leave(self):
+        if self.committing is not None:
+            self.entry.committing.discard(self.committing)
+            self.committing = None
+
+    def vote(self, committed, changes):
+        self.enter()
+        self.entry.lock.acquire()
+        self.locked = True
+        conflicts = self.entry.conflicts(changes, self.generation)
+        if conflicts:
+            raise self.entry.conflict_error(conflicts)
+        return self.storage.vote(committed, changes)
+
+    def finish(self, committed, changes):
+        entry = self.entry
+        try:
+            self.storage.finish(committed, changes)
+            entry.committed(changes)
+            self.generation = entry.generation
+        finally:
+            self.release()
+
+    def abort(self):
+        # the next transaction starts from what is committed now
+        self.generation = self.entry.generation
+        if self.locked:
+            try:
+                self.storage.abort()
+            finally:
+                self.release()
+
+    def release(self):
+        self.locked = False
+        self.leave()
+        self.entry.lock.release()
+
+
+class SharedEntry(object):
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.signature = storage.signature()
+        self.data = storage.load()
+        self.lock = threading.Lock()
+        self.group = None
+        # commits through this entry, and the last one to change each key
+        self.generation = 0
+        self.changed = {}
+        # the threads with a commit in progress
+        self.committing = set()
+
+    def conflicts(self, changes, generation):
+        """Return the keys in changes committed since generation."""
+        return [name for name in changes
+                if self.changed.get(name, 0) > generation]
+
+    def conflict_error(self, conflicts):
+        external = {}
+        for name in conflicts:
+            if name in self.data:
+                external[name] = self.data[name]
+            else:
+                external[name] = _DELETED
+        return ConflictError("Conflicting changes to %s" %
+                             ', '.join([repr(name) for name in conflicts]),
+                             external)
+
+    def committed(self, changes):
+        """Count a commit of changes made through the entry."""
+        self.signature = self.storage.signature()
+        self.generation += 1
+        for name in changes:
+            self.changed[name] = self.generation
+
+    def current(self):
+        if self.signature == self.storage.signature():
+            return True
+        # wait for a commit in progress, which changes the signature
+        self.lock.acquire()
+        try:
+            return self.signature == self.storage.signature()
+        finally:
+            self.lock.release()
+
+
+class GroupCommitStorage(SharedStorage):
+    """Commit the transactions of several threads with a single write.
+
+    Works like a SharedStorage, except that the transactions that vote
+    while an earlier batch is being written are collected into a batch of
+    up to ``size`` transactions, which waits a further ``window`` seconds
+    for more of them once it can be written. Then the changes of all of
+    them are voted on and, once every one of them has finished, written to
+    disk together, so a busy process pays for one write and one sync per
+    batch instead of one per transaction. Conflicts are found as with a
+    SharedStorage, once the earlier batches are written: a transaction
+    that changes a key committed since it began, or one that an earlier
+    transaction of its own batch changes, gets a ConflictError.
+
+    The metrics method returns the number of batches and of transactions
+    committed, and the average and longest commit times, from the start of
+    tpc_vote to the end of tpc_finish.
+    """
+
+    def __init__(self, storage, window=0, size=32):
+        SharedStorage.__init__(self, storage)
+        self.window = window
+        self.size = size
+        self.batch = None
+        self.started = None
+
+    def load(self):
+        data = SharedStorage.load(self)
+        self.entries_lock.acquire()
+        try:
+            if self.entry.group is None:
+                self.entry.group = CommitGroup()
+        finally:
+            self.entries_lock.release()
+        return data
+
+    def vote(self, committed, changes):
+        self.started = time.time()
+        # find the transaction of the batch that can't be pickled before
+        # voting, so the others are not thrown away with it
+        for value in changes.values():
+            if value is not _DELETED:
+                try:
+                    pickle.dumps(value)
+                except (TypeError, pickle.PicklingError):
+                    raise ValueError("Unpickleable value cannot be saved")
+        self.enter()
+        self.batch = self.entry.group.join(self, changes, self.window,
+                                           self.size)
+
+    def finish(self, committed, changes):
+        batch, self.batch = self.batch, None
+        self.leave()
+        batch.decide(self, True)
+        self.entry.group.record(time.time() - self.started)
+
+    def abort(self):
+        batch, self.batch = self.batch, None
+        self.leave()
+        if batch is not None:
+            batch.decide(self, False)
+        self.generation = self.entry.generation
+
+    def metrics(self):
+        return self.entry.group.metrics()
+
+
+class CommitGroup(object):
+    """The batches of transactions of a GroupCommitStorage entry."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.batch = None
+        self.batches = 0
+        self.commits = 0
+        self.largest = 0
+        self.latency = 0.0
+        self.longest = 0.0
+
+    def join(self, member, changes, window, size):
+        """Add the changes of a transaction to the open batch and wait
+        until the batch has voted.
+
+        The first transaction to join a batch collects the others and
+        votes for all of them.
+        """
+        self.lock.acquire()
+        try:
+            batch = self.batch
+            leader = batch is None
+            if leader:
+                batch = self.batch = CommitBatch(member.entry)
+            batch.join(member, changes, size)
+            if len(batch.members) >= size:
+                # a full batch is closed, the next transaction starts another
+                self.batch = None
+        finally:
+            self.lock.release()
+        if leader:
+            # transactions that vote while an earlier batch is still being
+            # written join this one
+            member.entry.lock.acquire()
+            batch.collect(window, size)
+            self.lock.acquire()
+            try:
+                if self.batch is batch:
+                    self.batch = None
+            finally:
+                self.lock.release()
+            batch.vote()
+            self.lock.acquire()
+            try:
+                self.batches += 1
+                self.largest = max(self.largest, len(batch.members))
+            finally:
+                self.lock.release()
+        batch.wait_voted(member)
+        return batch
+
+    def record(self, latency):
+        self.lock.acquire()
+        try:
+            self.commits += 1
+            self.latency += latency
+            self.longest = max(self.longest, latency)
+        finally:
+            self.lock.release()
+
+    def metrics(self):
+        self.lock.acquire()
+        try:
+            return {
+                'batches': self.batches,
+                'commits': self.commits,
+                'average_batch': self.batches and
+                                 float(self.commits) / self.batches,
+                'largest_batch': self.largest,
+                'average_latency': self.commits and
+                                   self.latency / self.commits,
+                'longest_latency': self.longest,
+            }
+        finally:
+            self.lock.release()
+
+
+class CommitBatch(object):
+    """Transactions voting and finishing together.
+
+    The batch holds the lock of the shared entry from the time it is closed
+    until every transaction in it has finished or aborted.
+    """
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.condition = threading.Condition(threading.Lock())
+        self.members = []
+        self.changes = {}
+        self.errors = {}
+        self.voted = None
+        self.decisions = {}
+        self.error = None
+        self.done = False
+
+    def join(self, member, changes, size):
+        self.condition.acquire()
+        try:
+            self.members.append(member)
+            self.changes[member] = changes
+            if len(self.members) >= size:
+                self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def collect(self, window, size):
+        deadline = time.time() + window
+        self.condition.acquire()
+        try:
+            while len(self.members) < size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+        finally:
+            self.condition.release()
+
+    def merged(self, members):
+        changes = {}
+        for member in members:
+            changes.update(self.changes[member])
+        return changes
+
+    def vote(self):
+        entry = self.entry
+        members = []
+        changed = {}
+        for member in self.members:
+            # the earlier batches are written, so the entry knows all the
+            # commits the transaction could have missed
+            changes = self.changes[member]
+            conflicts = entry.conflicts(changes, member.generation)
+            conflicts.extend([name for name in changes
+                              if name in changed and name not in conflicts])
+            if conflicts:
+                try:
+                    raise entry.conflict_error(conflicts)
+                except ConflictError:
+                    self.errors[member] = sys.exc_info()
+            else:
+                members.append(member)
+                changed.update(changes)
+        try:
+            while members:
+                try:
+                    entry.storage.vote(entry.data, self.merged(members))
+                    break
+                except ConflictError as error:
+                    # only the transactions that changed the same keys as
+                    # the other process have to be retried
+                    conflicting = [member for member in members
+                                   if [name for name in self.changes[member]
+                                       if name in error.changes]]
+                    for member in conflicting or list(members):
+                        self.errors[member] = sys.exc_info()
+                        members.remove(member)
+                except:
+                    for member in members:
+                        self.errors[member] = sys.exc_info()
+                    members = []
+            if not members:
+                entry.storage.abort()
+                entry.lock.release()
+        except:
+            entry.lock.release()
+            raise
+        self.condition.acquire()
+        try:
+            self.voted = members
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def wait_voted(self, member):
+        self.condition.acquire()
+        try:
+            while self.voted is None:
+                self.condition.wait()
+        finally:
+            self.condition.release()
+        if member in self.errors:
+            error_type, error, traceback = self.errors[member]
+            raise error_type, error, traceback
+
+    def decide(self, member, commit):
+        """Record whether a transaction of the batch commits or aborts.
+
+        The last transaction to decide writes the batch, and the ones that
+        commit wait for the write to finish.
+        """
+        self.condition.acquire()
+        try:
+            self.decisions[member] = commit
+            if len(self.decisions) == len(self.voted):
+                self.write()
+                self.condition.notifyAll()
+            while not self.done:
+                self.condition.wait()
+        finally:
+            self.condition.release()
+        if commit and self.error is not None:
+            error_type, error, traceback = self.error
+            raise error_type, error, traceback
+
+    def write(self):
+        entry = self.entry
+        members = [member for member in self.voted if self.decisions[member]]
+        try:
+            try:
+                if len(members) < len(self.voted):
+                    # vote again without the transactions that aborted
+                    entry.storage.abort()
+                    if members:
+                        entry.storage.vote(entry.data, self.merged(members))
+                if members:
+                    changes = self.merged(members)
+                    entry.storage.finish(entry.data, changes)
+                    entry.committed(changes)
+                    for member in members:
+                        member.generation = entry.generation
+            except:
+                self.error = sys.exc_info()
+                entry.storage.abort()
+        finally:
+            self.done = True
+            entry.lock.release()
@@ -5,21 +5,28 @@ from pyramid.view import view_config
 
 from todo.resources import Root
 from todo.pickledm import PickleDataManager
+from todo.pickledm import PickleStorage
+from todo.statsdm import InstrumentedDataManager
+from todo.statsdm import TransactionStats
+from todo.storages import OrderedStorage
+from todo.storages import SharedStorage
+
+stats = TransactionStats()
 
 class TodoView(object):
 
     def __init__(self, request):
         self.request = request
-        self.dm = PickleDataManager()
+        storage = SharedStorage(OrderedStorage(PickleStorage()))
+        self.dm = PickleDataManager(storage=storage)
         t = transaction.get()
-        t.join(self.dm)
+        t.join(InstrumentedDataManager(self.dm, stats))
 
     @view_config(context=Root,
                  request_method='GET',
                  renderer='todo:templates/todo.pt')
     def todo_view(self):
-        tasks = self.dm.items()
-        tasks.sort()
+        tasks = self.dm.items(sorted=True)
         return { 'tasks': tasks, 'status': None }
 
     @view_config(context=Root,
@@ -29,8 +36,7 @@ class TodoView(object):
         text = self.request.params.get('text')
         key = str(time.time())
         self.dm[key] = {'task_description': text, 'task_completed': False}
-        tasks = self.dm.items()
-        tasks.sort()
+        tasks = self.dm.items(sorted=True)
         return { 'tasks': tasks, 'status': 'New task inserted.' }
 
     @view_config(context=Root,
@@ -39,9 +45,8 @@ class TodoView(object):
     def done_view(self):
         tasks = self.request.params.getall('tasks')
         for task in tasks:
-            self.dm[task]['task_completed'] = True
-        tasks = self.dm.items()
-        tasks.sort()
+            self.dm[task] = dict(self.dm[task], task_completed=True)
+        tasks = self.dm.items(sorted=True)
         return { 'tasks': tasks, 'status': 'Marked tasks as done.' }
 
     @view_config(context=Root,
@@ -50,9 +55,8 @@ class TodoView(object):
     def not_done_view(self):
         tasks = self.request.params.getall('tasks')
         for task in tasks:
-            self.dm[task]['task_completed'] = False
-        tasks = self.dm.items()
-        tasks.sort()
+            self.dm[task] = dict(self.dm[task], task_completed=False)
+        tasks = self.dm.items(sorted=True)
         return { 'tasks': tasks, 'status': 'Marked tasks as not done.' }
 
     @view_config(context=Root,
@@ -62,7 +66,9 @@ class TodoView(object):
         tasks = self.request.params.getall('tasks')
         for task in tasks:
             del(self.dm[task])
-        tasks = self.dm.items()
-        tasks.sort()
+        tasks = self.dm.items(sorted=True)
         return { 'tasks': tasks, 'status': 'Deleted tasks.' }
 
+    @view_config(context=Root, name='stats', renderer='json')
+    def stats_view(self):
+        return stats.summary()
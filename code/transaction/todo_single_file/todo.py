@@ -10,10 +10,13 @@ from pyramid.config import Configurator
 from repoze.tm import TM
 from repoze.tm import default_commit_veto
 
-from pickledm import PickleDataManager
+from pickledm import PickleDataManager, PickleStorage
+from statsdm import InstrumentedDataManager, TransactionStats
+from storages import OrderedStorage, SharedStorage
 
 here = os.path.dirname(os.path.abspath(__file__))
 template = os.path.join(here, 'todo.pt')
+stats = TransactionStats()
 
 class Root(object):
     def __init__(self, request):
@@ -23,14 +26,14 @@ class TodoView(object):
 
     def __init__(self, request):
         self.request = request
-        self.dm = PickleDataManager()
+        storage = SharedStorage(OrderedStorage(PickleStorage()))
+        self.dm = PickleDataManager(storage=storage)
         t = transaction.get()
-        t.join(self.dm)
+        t.join(InstrumentedDataManager(self.dm, stats))
 
     @view_config(context=Root, request_method='GET', renderer=template)
     def todo_view(self):
-        tasks = self.dm.items()
-        tasks.sort()
+        tasks = self.dm.items(sorted=True)
         return { 'tasks': tasks, 'status': None }
 
     @view_config(context=Root, request_param='add', renderer=template)
@@ -38,26 +41,23 @@ class TodoView(object):
         text = self.request.params.get('text')
         key = str(time.time())
         self.dm[key] = {'task_description': text, 'task_completed': False}
-        tasks = self.dm.items()
-        tasks.sort()
+        tasks = self.dm.items(sorted=True)
         return { 'tasks': tasks, 'status': 'New task inserted.' }
 
     @view_config(context=Root, request_param='done', renderer=template)
     def done_view(self):
         tasks = self.request.params.getall('tasks')
         for task in tasks:
-            self.dm[task]['task_completed'] = True
-        tasks = self.dm.items()
-        tasks.sort()
+            self.dm[task] = dict(self.dm[task], task_completed=True)
+        tasks = self.dm.items(sorted=True)
         return { 'tasks': tasks, 'status': 'Marked tasks as done.' }
 
     @view_config(context=Root, request_param='not done', renderer=template)
     def not_done_view(self):
         tasks = self.request.params.getall('tasks')
         for task in tasks:
-            self.dm[task]['task_completed'] = False
-        tasks = self.dm.items()
-        tasks.sort()
+            self.dm[task] = dict(self.dm[task], task_completed=False)
+        tasks = self.dm.items(sorted=True)
         return { 'tasks': tasks, 'status': 'Marked tasks as not done.' }
 
     @view_config(context=Root, request_param='delete', renderer=template)
@@ -65,10 +65,13 @@ class TodoView(object):
         tasks = self.request.params.getall('tasks')
         for task in tasks:
             del(self.dm[task])
-        tasks = self.dm.items()
-        tasks.sort()
+        tasks = self.dm.items(sorted=True)
         return { 'tasks': tasks, 'status': 'Deleted tasks.' }
 
+    @view_config(context=Root, name='stats', renderer='json')
+    def stats_view(self):
+        return stats.summary()
+
 if __name__ == '__main__':
     settings = {}
     config = Configurator(root_factory=Root, settings=settings)